@@ -1,25 +1,22 @@
-import requests
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import threading
 import os
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
-import zipfile
 import sys
-import ctypes
-import hashlib
+
+from lineageos_core import LineageOSCore, APP_VERSION, DEVICE_ALIASES, configure_logging, format_size
+from events import EventBus, ProgressTracker, format_eta
 
 class LineageOSDownloader:
     def __init__(self, master):
         self.master = master
         self.master.title("Switchroot LineageOS Downloader")
-        self.master.geometry("500x450")
+        self.master.geometry("560x580")
         self.style = ttk.Style()
 
         # Define the app version
-        self.app_version = "v1.0.3"  # Updated version
+        self.app_version = APP_VERSION
 
         # Configure dark theme
         self.style.theme_use('clam')
@@ -40,40 +37,37 @@ class LineageOSDownloader:
                              troughcolor='#3d3d3d', 
                              background='#00cc66',
                              thickness=15)
+        self.style.configure("Treeview", background='#3d3d3d', fieldbackground='#3d3d3d',
+                             foreground='white', font=('Segoe UI', 9))
+        self.style.configure("Treeview.Heading", background='#2b2b2b', foreground='#888888')
 
         # Initialize variables
         self.device_type = tk.StringVar(value="tablet")
         self.download_gapps = tk.BooleanVar(value=False)  # New variable for GApps
-        self.download_urls = []
-        self.total_downloaded = 0
-        self.total_size = 0
         self.download_dir = os.path.expanduser("~/Downloads")
-        self.cancel_download = False
-        self.retry_attempts = 3
-        self.permanent_links = [
-            "https://wiki.lineageos.org/images/device_specific/nx/bootlogo_android.bmp",
-            "https://wiki.lineageos.org/images/device_specific/nx/icon_android_hue.bmp"
-        ]
-        self.last_update_time = 0
-        self.latest_build = None
-        self.target_dir = None
-        self.failed_downloads = []
-        self.gapps_url = None  # Store GApps URL
-        self.gapps_filename = None  # Store GApps filename
-        self.gapps_checksums = {}  # Store checksums for verification
-        self.session = requests.Session()
-        self.connect_timeout = 10
-        self.read_timeout = 60
+        self.plan = None
+        self.batch = None  # All plans of a batch restored from the journal, or after a retry
+        self.downloading = False
+        self.refresh_interval = 100  # ms between event queue drains
+        self.resolve_request = 0  # Only results of the latest build lookup are shown
+        self.resolve_speculative = False
 
         # Configure logging
-        logging.basicConfig(
-            filename='lineageos_downloader.log',
-            level=logging.DEBUG,
-            format='%(asctime)s:%(levelname)s:%(message)s'
-        )
+        configure_logging()
+
+        # All fetch/download work lives in the core; workers post events and only
+        # the Tk thread touches widgets, once per refresh tick
+        self.events = EventBus()
+        self.tracker = ProgressTracker()
+        self.core = LineageOSCore(events=self.events)
 
         self.create_widgets()
         self.master.report_callback_exception = self.handle_gui_errors
+        self.master.after(self.refresh_interval, self.drain_events)
+        self.restore_interrupted_download()
+        if not self.plan:
+            # Look the build up while the window paints, so Check Build usually has it already
+            self.master.after(self.refresh_interval, self.on_selection_changed)
 
     def create_widgets(self):
         main_frame = ttk.Frame(self.master, padding="10 10 10 10")
@@ -89,11 +83,11 @@ class LineageOSDownloader:
         variants_frame = ttk.LabelFrame(main_frame, text=" Choose Variants ", padding=10)
         variants_frame.pack(fill=tk.X, pady=5)
         ttk.Radiobutton(variants_frame, text="Tablet", variable=self.device_type, 
-                        value="tablet").pack(side=tk.LEFT, padx=15)
+                        value="tablet", command=self.on_selection_changed).pack(side=tk.LEFT, padx=15)
         ttk.Radiobutton(variants_frame, text="TV", variable=self.device_type, 
-                        value="tv").pack(side=tk.LEFT, padx=15)
+                        value="tv", command=self.on_selection_changed).pack(side=tk.LEFT, padx=15)
         ttk.Checkbutton(variants_frame, text="Download MindTheGapps", 
-                        variable=self.download_gapps).pack(side=tk.LEFT, padx=15)
+                        variable=self.download_gapps, command=self.on_selection_changed).pack(side=tk.LEFT, padx=15)
 
         # Action Buttons
         btn_frame = ttk.Frame(main_frame)
@@ -132,6 +126,21 @@ class LineageOSDownloader:
                                         font=('Segoe UI', 9), foreground='#888888')
         self.progress_label.pack(fill=tk.X)
 
+        # Per-file rows
+        files_frame = ttk.Frame(main_frame)
+        files_frame.pack(fill=tk.X, pady=5)
+        self.files_tree = ttk.Treeview(files_frame, columns=("progress", "status"), height=5)
+        self.files_tree.heading("#0", text="File")
+        self.files_tree.heading("progress", text="Progress")
+        self.files_tree.heading("status", text="Status")
+        self.files_tree.column("#0", width=300)
+        self.files_tree.column("progress", width=80, anchor=tk.E)
+        self.files_tree.column("status", width=100)
+        files_vsb = ttk.Scrollbar(files_frame, orient="vertical", command=self.files_tree.yview)
+        self.files_tree.configure(yscrollcommand=files_vsb.set)
+        self.files_tree.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        files_vsb.pack(side=tk.RIGHT, fill=tk.Y)
+
         # Logs
         log_frame = ttk.Frame(main_frame)
         log_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -156,11 +165,32 @@ class LineageOSDownloader:
         messagebox.showerror("Application Error", f"{exc_type.__name__}: {exc_value}")
 
     def log_message(self, message):
+        self.core.log_message(message)
+
+    def append_log(self, messages):
         self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, message + "\n")
+        self.log_text.insert(tk.END, "".join(message + "\n" for message in messages))
         self.log_text.config(state=tk.DISABLED)
         self.log_text.see(tk.END)
-        logging.info(message)
+
+    def drain_events(self):
+        try:
+            messages, other = self.tracker.apply(self.events.drain())
+            if messages:
+                self.append_log(messages)
+            if self.downloading:
+                self.refresh_progress()
+            for event in other:
+                if event['kind'] == 'error':
+                    messagebox.showerror("Error", event['message'])
+                elif event['kind'] == 'run_finished':
+                    self.reset_ui()
+                elif event['kind'] in ('build_found', 'plan_ready', 'resolve_failed'):
+                    self.handle_resolution(event)
+        except Exception as e:
+            logging.error(f"Progress update error: {e}")
+        finally:
+            self.master.after(self.refresh_interval, self.drain_events)
 
     def clear_logs(self):
         self.log_text.config(state=tk.NORMAL)
@@ -188,362 +218,161 @@ class LineageOSDownloader:
         else:
             self.log_message("Using default download directory")
 
-    def fetch_latest_build(self):
-        device = "nx_tab" if self.device_type.get() == "tablet" else "nx"
-        url = f"https://download.lineageos.org/api/v2/devices/{device}/builds"
-        try:
-            self.log_message(f"Fetching latest build from: {url}")
-            response = self.session.get(url, timeout=(self.connect_timeout, self.read_timeout))
-            response.raise_for_status()
-            builds = response.json()
-            if not builds:
-                raise ValueError("No builds found in response")
-            return max(builds, key=lambda x: x['date'])
-        except Exception as e:
-            self.log_message(f"Error fetching builds: {str(e)}")
-            raise
-
-    def fetch_gapps_url(self):
-        if not self.latest_build:
-            self.log_message("No build information available. Cannot fetch GApps.")
-            return None, None
-        version = self.latest_build['version']
-        device_type = self.device_type.get().lower()
-        gapps_suffix = "arm64" if device_type == "tablet" else "arm64-ATV"
-        
-        # Map LineageOS version to Android version
-        version_map = {
-            "20.0": "13",
-            "21.0": "14",
-            "22.0": "15",
-            "22.1": "15"
-        }
-        android_version = version_map.get(version, "15")  # Default to 15 for unknown versions
-        github_api = f"https://api.github.com/repos/MindTheGapps/{android_version}.0.0-{gapps_suffix}/releases/latest"
-        
-        try:
-            self.log_message(f"Fetching MindTheGapps from: {github_api}")
-            headers = {'Accept': 'application/vnd.github.v3+json'}
-            response = self.session.get(
-                github_api,
-                headers=headers,
-                timeout=(self.connect_timeout, self.read_timeout)
-            )
-            response.raise_for_status()
-            gapps_json = response.json()
-            gapps_url = None
-            gapps_filename = None
-            for asset in gapps_json.get('assets', []):
-                name = asset['name']
-                if (f"MindTheGapps-{android_version}.0.0-{gapps_suffix}" in name and
-                    "arm64" in name and name.endswith(".zip")):
-                    gapps_url = asset['browser_download_url']
-                    gapps_filename = name
-                    break
-            if not gapps_url:
-                self.log_message("Error: No matching MindTheGapps package found!")
-                return None, None
-            self.log_message(f"Found MindTheGapps: {gapps_filename}")
-            return gapps_url, gapps_filename
-        except Exception as e:
-            self.log_message(f"Error fetching MindTheGapps: {str(e)}")
-            return None, None
+    def selected_device(self):
+        return DEVICE_ALIASES[self.device_type.get().lower()]
 
-    def check_latest_build(self):
-        try:
-            self.latest_build = self.fetch_latest_build()
-            version = self.latest_build['version']
-            date = self.latest_build['date'].replace("-", "")
-            self.build_label.config(text=f"{version}-{date}")
-            self.download_urls = [
-                file['url']
-                for file in self.latest_build['files']
-                if 'super_empty.img' not in file['url']
-            ]
-            self.download_urls.extend(self.permanent_links)
-            # Store checksums for verification
-            for file in self.latest_build['files']:
-                if 'super_empty.img' not in file['url']:
-                    self.gapps_checksums[file['url']] = file.get('sha256')
-            # Fetch GApps URL if selected
-            if self.download_gapps.get():
-                self.gapps_url, self.gapps_filename = self.fetch_gapps_url()
-                if self.gapps_url:
-                    self.download_urls.append(self.gapps_url)
-            self.log_message("Successfully fetched build information")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to fetch build: {str(e)}")
+    def check_latest_build(self, speculative=False):
+        # The lookup runs on worker threads; results come back through the event queue
+        if self.downloading:
+            return
+        self.resolve_request += 1
+        self.resolve_speculative = speculative
+        self.build_label.config(text="Checking...")
+        self.core.resolve_plan_async(self.selected_device(), gapps=self.download_gapps.get(),
+                                     request=self.resolve_request)
+
+    def on_selection_changed(self):
+        self.check_latest_build(speculative=True)
+
+    def handle_resolution(self, event):
+        if event['request'] != self.resolve_request or self.downloading:
+            return  # The selection changed since; a newer lookup is on its way
+        if event['kind'] == 'resolve_failed':
+            self.build_label.config(text="-")
+            if self.resolve_speculative:
+                self.log_message(f"Could not fetch build information: {event['message']}")
+            else:
+                messagebox.showerror("Error", f"Failed to fetch build: {event['message']}")
+        elif event['kind'] == 'build_found':
+            gapps = " (looking up GApps...)" if self.download_gapps.get() else ""
+            self.build_label.config(text=event['label'] + gapps)
+        else:
+            self.plan = event['plan']
+            self.batch = None
+            self.build_label.config(text=self.plan.label())
+
+    def restore_interrupted_download(self):
+        # The journal holds the plan of a download that was cut short, so it can
+        # continue without checking the build again
+        plans = self.core.load_unfinished_plans()
+        if not plans:
+            return
+        self.plan = plans[0]
+        self.batch = plans
+        self.download_dir = os.path.dirname(self.plan.target_dir)
+        for alias, device in DEVICE_ALIASES.items():
+            if device == self.plan.device:
+                self.device_type.set(alias)
+        self.download_gapps.set(bool(self.plan.gapps_url))
+        self.build_label.config(text=self.plan.label())
+        self.download_btn.config(state=tk.NORMAL)
+        self.log_message("Press Download to resume it.")
 
     def create_folders_and_ini(self):
-        if not self.latest_build:
+        if not self.plan:
             self.log_message("No build information available. Please check the latest build first.")
             return
 
-        build_info = self.build_label.cget("text").split('-')
-        version = build_info[0]
-        date = build_info[1]
-        device_type = "TV" if self.device_type.get().lower() == "tv" else "Tablet"
-        folder_name = f"LineageOS-{version}-{date}-{device_type}"
-        self.target_dir = os.path.join(self.download_dir, folder_name)
-
         try:
-            os.makedirs(self.target_dir, exist_ok=True)
-            os.makedirs(os.path.join(self.target_dir, "switchroot", "install"), exist_ok=True)
-            os.makedirs(os.path.join(self.target_dir, "switchroot", "android"), exist_ok=True)
-            os.makedirs(os.path.join(self.target_dir, "bootloader", "ini"), exist_ok=True)
-
-            ini_content = """[LineageOS]
-l4t=1
-boot_prefixes=switchroot/android/
-id=SWANDR
-icon=switchroot/android/icon_android_hue.bmp
-logopath=switchroot/android/bootlogo_android.bmp
-r2p_action=self
-; alarms_disable=1 uncomment to disable notifications for better battery life
-; touch_skip_tuning=1 uncomment if your touchscreen is broken
-; usb3_enable=1 uncomment for faster USB at expense of WiFi/BT quality
-; ddr200_enable=1 uncomment for faster SD speed on models that support it (Samsung enabled by default)
-; emmc=1 uncomment to boot from the internal eMMC (not reccomended, and requires a signifigantly different set of installation instructions/partitioning process)
-"""
-            with open(os.path.join(self.target_dir, "bootloader", "ini", "android.ini"), "w") as f:
-                f.write(ini_content)
-
-            self.log_message(f"Created folders and generated android.ini in: {self.target_dir}")
+            self.core.create_folders_and_ini(self.plan, self.download_dir)
         except Exception as e:
             self.log_message(f"Error creating folders or generating ini file: {str(e)}")
             messagebox.showerror("Error", f"Failed to create folders or generate ini file: {str(e)}")
 
     def start_download(self):
-        if not self.download_urls:
+        if not self.plan or not self.plan.urls:
             messagebox.showwarning("Warning", "No files available to download")
             return
+        if not self.download_dir:
+            messagebox.showwarning("Warning", "Select a download folder first")
+            return
         self.download_btn.config(state=tk.DISABLED)
         self.cancel_btn.config(state=tk.NORMAL)
         self.retry_btn.config(state=tk.DISABLED)
+        self.progress_bar['value'] = 0
+        self.progress_label.config(text="Starting download...")
+        self.tracker.reset()
+        self.files_tree.delete(*self.files_tree.get_children())
+        self.downloading = True
         threading.Thread(target=self.prepare_and_start_download, daemon=True).start()
 
     def prepare_and_start_download(self):
         try:
-            self.progress_bar['value'] = 0
-            self.total_downloaded = 0
-            self.cancel_download = False
-            self.failed_downloads = []
-            self.total_files = len(self.download_urls)
-            self.log_message(f"Total files to download: {self.total_files}")
-            self.progress_label.config(text="Starting download...")
-            self.master.update_idletasks()
-
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                futures = [executor.submit(self.download_file, url) 
-                          for url in self.download_urls]
-                for future in as_completed(futures):
-                    if self.cancel_download:
-                        break
-            if not self.cancel_download:
-                if self.failed_downloads:
-                    failed_files = ", ".join(os.path.basename(url) for url in self.failed_downloads)
-                    self.log_message(f"Download finished with failures: {failed_files}")
-                    self.log_message("Use Retry Failed or try another network/VPN if the same mirror keeps timing out.")
-                else:
-                    self.log_message("Download complete! Files are organized in the target folder.")
+            if not self.plan.target_dir:
+                self.core.create_folders_and_ini(self.plan, self.download_dir)
+            self.core.download_batch(self.batch or [self.plan])
         except Exception as e:
             self.log_message(f"Download failed: {str(e)}")
-            messagebox.showerror("Error", str(e))
+            self.events.post('error', message=str(e))
         finally:
-            self.master.after(0, self.reset_ui)
-
-    def download_file(self, url):
-        filename = os.path.basename(url)
-        truncated_filename = (filename[:20] + '...') if len(filename) > 20 else filename
-
-        # Determine the target folder based on file type
-        if filename in ["boot.img", "recovery.img", "nx-plat.dtimg"]:
-            target_folder = os.path.join(self.target_dir, "switchroot", "install")
-        elif filename in ["bl31.bin", "bl33.bin", "boot.scr", "icon_android_hue.bmp", "bootlogo_android.bmp"]:
-            target_folder = os.path.join(self.target_dir, "switchroot", "android")
-        elif filename.startswith("MindTheGapps"):
-            target_folder = self.target_dir  # GApps go to root folder
-        else:
-            target_folder = self.target_dir  # Default to root folder (e.g., LineageOS ZIP)
-
-        os.makedirs(target_folder, exist_ok=True)
-        file_path = os.path.join(target_folder, filename)
-        temp_file_path = file_path + ".part"
-
-        # Fetch the checksum from the API or None for GApps
-        expected_checksum = self.gapps_checksums.get(url)
-
-        for attempt in range(1, self.retry_attempts + 1):
-            if self.cancel_download:
-                return
+            self.events.post('run_finished')
 
-            try:
-                if os.path.exists(file_path):
-                    if expected_checksum:
-                        if self.verify_checksum(file_path, expected_checksum):
-                            self.log_message(f"File already exists and is complete: {filename}")
-                            return
-                        else:
-                            self.log_message(f"Existing file is corrupted. Deleting: {filename}")
-                            os.remove(file_path)
-                    else:
-                        if filename.endswith(".zip") and not self.is_valid_zip(file_path):
-                            self.log_message(f"Existing ZIP file is corrupted. Deleting: {filename}")
-                            os.remove(file_path)
-                        else:
-                            self.log_message(f"File already exists: {filename}")
-                            return
-
-                self.log_message(f"Downloading {filename} (Attempt {attempt})")
-                downloaded_size = 0
-                if os.path.exists(temp_file_path):
-                    downloaded_size = os.path.getsize(temp_file_path)
-                    self.log_message(f"Resuming partial download: {filename} from {self.format_size(downloaded_size)}")
-
-                headers = {"Range": f"bytes={downloaded_size}-"} if downloaded_size else {}
-                response = self.session.get(
-                    url,
-                    headers=headers,
-                    stream=True,
-                    timeout=(self.connect_timeout, self.read_timeout),
-                    allow_redirects=True
-                )
-                response.raise_for_status()
-                if attempt == 1:
-                    self.log_download_source(url, response, downloaded_size)
-
-                if downloaded_size and response.status_code == 200:
-                    self.log_message(f"Server did not resume {filename}; restarting from the beginning")
-                    downloaded_size = 0
-                    headers = {}
-                    response.close()
-                    response = self.session.get(
-                        url,
-                        headers=headers,
-                        stream=True,
-                        timeout=(self.connect_timeout, self.read_timeout),
-                        allow_redirects=True
-                    )
-                    response.raise_for_status()
-
-                total_size = int(response.headers.get('Content-Length', 0)) + downloaded_size
-                with open(temp_file_path, 'ab' if downloaded_size else 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if self.cancel_download:
-                            return
-                        if chunk:
-                            f.write(chunk)
-                            downloaded_size += len(chunk)
-                            file_progress = (downloaded_size / total_size) * 100 if total_size > 0 else 0
-                            self.master.after(0, self.update_progress, truncated_filename, file_progress)
-
-                if expected_checksum:
-                    if not self.verify_checksum(temp_file_path, expected_checksum):
-                        raise ValueError(f"Checksum mismatch for {filename}")
-                elif filename.endswith(".zip"):
-                    if not self.is_valid_zip(temp_file_path):
-                        raise ValueError(f"Invalid ZIP file: {filename}")
-
-                os.rename(temp_file_path, file_path)
-                self.log_message(f"Finished download: {filename}")
-                self.total_downloaded += 1
-                return
-
-            except Exception as e:
-                self.log_message(f"Attempt {attempt} failed: {str(e)}")
-                if attempt == self.retry_attempts:
-                    self.failed_downloads.append(url)
-                    self.log_message(f"Permanent failure for {filename}")
-
-    def log_download_source(self, original_url, response, downloaded_size):
-        final_url = response.url
-        total_size = int(response.headers.get('Content-Length', 0)) + downloaded_size
-        accept_ranges = response.headers.get('Accept-Ranges', 'not reported')
-        if final_url != original_url:
-            self.log_message(f"Mirror: {final_url}")
-        self.log_message(
-            f"Download info: size={self.format_size(total_size)}, resume={accept_ranges}, timeout={self.read_timeout}s"
+    def refresh_progress(self):
+        if self.core.cancel_download:
+            return
+        done, total = self.tracker.totals()
+        self.progress_bar["value"] = self.tracker.percent()
+        self.progress_label.config(
+            text=f"{self.tracker.completed_files()} of {len(self.tracker.files)} files | "
+                 f"{format_size(done)} of {format_size(total)} | "
+                 f"{format_size(self.tracker.speed())}/s | ETA {format_eta(self.tracker.eta())}",
+            foreground='#00cc66'
         )
-
-    def calculate_checksum(self, file_path):
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                sha256_hash.update(chunk)
-        return sha256_hash.hexdigest()
-
-    def verify_checksum(self, file_path, expected_checksum):
-        actual_checksum = self.calculate_checksum(file_path)
-        return actual_checksum == expected_checksum
-
-    def is_valid_zip(self, file_path):
-        try:
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                return zip_ref.testzip() is None
-        except zipfile.BadZipFile:
-            return False
-
-    def update_progress(self, filename, file_progress):
-        try:
-            current_time = time.time() * 1000
-            if current_time - self.last_update_time < 100:
-                return
-            self.progress_bar["value"] = file_progress
-            self.progress_label.config(
-                text=f"Downloading {filename} ({file_progress:.1f}%) | Total {self.total_downloaded} of {self.total_files}",
-                foreground='#00cc66'
-            )
-            self.last_update_time = current_time
-        except ZeroDivisionError:
-            self.progress_label.config(text="Calculating progress...")
-        except Exception as e:
-            logging.error(f"Progress update error: {e}")
-
-    def format_size(self, size_bytes):
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.1f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.1f} TB"
+        for key, name, percent, status in self.tracker.rows():
+            values = (f"{percent:.1f}%", status)
+            if self.files_tree.exists(key):
+                if self.files_tree.item(key, "values") != values:
+                    self.files_tree.item(key, values=values)
+            else:
+                self.files_tree.insert("", tk.END, iid=key, text=name, values=values)
 
     def reset_ui(self):
+        self.downloading = False
+        self.refresh_progress()
         self.download_btn.config(state=tk.NORMAL)
         self.cancel_btn.config(state=tk.DISABLED)
-        if self.cancel_download:
+        if self.core.cancel_download:
             self.progress_label.config(text="Download Canceled", foreground='#ff4444')
-        elif self.failed_downloads:
+        elif self.core.failed_downloads:
             self.progress_label.config(
-                text=f"Download finished with failures. {self.total_downloaded} of {self.total_files} files downloaded.",
+                text=f"Download finished with failures. {self.core.total_downloaded} of {self.core.total_files} files downloaded.",
                 foreground='#ff4444'
             )
         else:
-            self.progress_label.config(text=f"Download Complete! {self.total_downloaded} of {self.total_files} files downloaded.", foreground='#00cc66')
+            self.progress_label.config(text=f"Download Complete! {self.core.total_downloaded} of {self.core.total_files} files downloaded.", foreground='#00cc66')
         self.progress_bar["value"] = 0
-        if not self.cancel_download and not self.failed_downloads:
+        if not self.core.cancel_download and not self.core.failed_downloads:
             self.master.after(2000, lambda: self.progress_label.config(
                 text="Ready",
                 foreground='#888888'
             ))
-        if self.failed_downloads:
+        if self.core.failed_downloads:
             self.retry_btn.config(state=tk.NORMAL)
 
     def cancel_download_process(self):
-        self.cancel_download = True
+        self.core.cancel()
         self.log_message("Canceling download...")
         self.progress_label.config(text="Canceling...", foreground='#ff4444')
         self.progress_bar['value'] = 0
         self.master.update_idletasks()
 
     def retry_failed_downloads(self):
-        if not self.failed_downloads:
+        if not self.core.failed_downloads:
             self.log_message("No failed downloads to retry.")
             return
         self.log_message("Retrying failed downloads...")
-        self.download_urls = self.failed_downloads
-        self.failed_downloads = []
+        failed = set(self.core.failed_downloads)
+        plans = [plan.subset([url for url in plan.urls if url in failed]) for plan in self.batch or [self.plan]]
+        self.batch = [plan for plan in plans if plan.urls]
+        self.plan = self.batch[0]
+        self.core.failed_downloads = []
         self.start_download()
 
 if __name__ == "__main__":
+    import ctypes
+    import multiprocessing
+    # ZIP CRC checks use a process pool, which needs this in the frozen exe
+    multiprocessing.freeze_support()
     root = tk.Tk()
     if getattr(sys, 'frozen', False):
         script_dir = sys._MEIPASS
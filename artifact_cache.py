@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+
+from file_utils import format_size, write_json_atomic
+
+FICLONE = 0x40049409  # Linux ioctl for copy-on-write clones (btrfs, xfs)
+
+
+class ArtifactCache:
+    def __init__(self, root, max_bytes=8 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(root, "index.json")
+        self.index = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('entries', {})
+        index.setdefault('aliases', {})
+        index.setdefault('stats', {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0})
+        return index
+
+    def save_index(self):
+        write_json_atomic(self.index_path, self.index)
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    def lookup(self, sha256):
+        with self.lock:
+            entry = self.index['entries'].get(sha256)
+            if not entry:
+                return None
+            path = self.object_path(sha256)
+            try:
+                if os.path.getsize(path) != entry['size']:
+                    raise OSError("size changed")
+            except OSError:
+                self.drop_entry(sha256)
+                self.save_index()
+                return None
+            return path
+
+    def lookup_alias(self, url, etag=None, last_modified=None, size=None):
+        # Files without a published sha256 are matched by URL plus HTTP validators
+        with self.lock:
+            alias = self.index['aliases'].get(url)
+        if not alias:
+            return None
+        if not (etag or last_modified):
+            return None
+        if etag and alias.get('etag') != etag:
+            return None
+        if not etag and alias.get('last_modified') != last_modified:
+            return None
+        if size and alias.get('size') != size:
+            return None
+        return alias['sha256']
+
+    def link_into(self, sha256, dest_path, copy=None):
+        # copy(source, dest) -> method replaces clone_file, e.g. for staged SD card writes
+        source = self.lookup(sha256)
+        if source is None:
+            return None
+        dest_dir = os.path.dirname(dest_path)
+        if dest_dir:
+            os.makedirs(dest_dir, exist_ok=True)
+        tmp_path = dest_path + ".cache"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        method = (copy or self.clone_file)(source, tmp_path)
+        os.replace(tmp_path, dest_path)
+        with self.lock:
+            entry = self.index['entries'][sha256]
+            entry['last_used'] = time.time()
+            stats = self.index['stats']
+            stats['hits'] += 1
+            stats['bytes_saved'] += entry['size']
+            self.save_index()
+        return method
+
+    def touch(self, sha256):
+        # A hit served straight from the object file (cache server) rather than linked into a tree
+        with self.lock:
+            entry = self.index['entries'].get(sha256)
+            if not entry:
+                return
+            entry['last_used'] = time.time()
+            stats = self.index['stats']
+            stats['hits'] += 1
+            stats['bytes_saved'] += entry['size']
+            self.save_index()
+
+    def record_miss(self):
+        with self.lock:
+            self.index['stats']['misses'] += 1
+            self.save_index()
+
+    def add(self, sha256, src_path, url=None, etag=None, last_modified=None):
+        size = os.path.getsize(src_path)
+        if size > self.max_bytes:
+            return False
+        path = self.object_path(sha256)
+        if not os.path.exists(path):
+            # Copy outside the lock; a large copy must not stall other lookups
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.clone_file(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        with self.lock:
+            if sha256 not in self.index['entries']:
+                self.index['entries'][sha256] = {'size': size, 'added': time.time()}
+            self.index['entries'][sha256]['last_used'] = time.time()
+            if url and (etag or last_modified):
+                self.index['aliases'][url] = {
+                    'sha256': sha256,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'size': size
+                }
+            self.evict()
+            self.save_index()
+        return True
+
+    def evict(self):
+        entries = self.index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for sha256 in sorted(entries, key=lambda key: entries[key].get('last_used', 0)):
+            if total <= self.max_bytes:
+                break
+            total -= entries[sha256]['size']
+            self.drop_entry(sha256)
+            self.index['stats']['evictions'] += 1
+
+    def drop_entry(self, sha256):
+        self.index['entries'].pop(sha256, None)
+        for url in [url for url, alias in self.index['aliases'].items() if alias['sha256'] == sha256]:
+            del self.index['aliases'][url]
+        try:
+            os.remove(self.object_path(sha256))
+        except OSError:
+            pass
+
+    def clone_file(self, source, dest):
+        # Hardlink when on the same volume, reflink where supported, else copy
+        try:
+            os.link(source, dest)
+            return "hardlink"
+        except OSError:
+            pass
+        if sys.platform.startswith("linux"):
+            try:
+                import fcntl
+                with open(source, "rb") as src, open(dest, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except (OSError, ImportError):
+                if os.path.exists(dest):
+                    os.remove(dest)
+        shutil.copyfile(source, dest)
+        return "copy"
+
+    def stats(self):
+        with self.lock:
+            entries = self.index['entries']
+            stats = dict(self.index['stats'])
+            stats['entries'] = len(entries)
+            stats['bytes_stored'] = sum(entry['size'] for entry in entries.values())
+            stats['max_bytes'] = self.max_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def format_stats(self):
+        stats = self.stats()
+        return "\n".join([
+            f"Artifact cache: {self.root}",
+            f"Entries: {stats['entries']} ({format_size(stats['bytes_stored'])} of {format_size(stats['max_bytes'])})",
+            f"Hits: {stats['hits']}  Misses: {stats['misses']}  Hit rate: {stats['hit_rate'] * 100:.1f}%",
+            f"Saved: {format_size(stats['bytes_saved'])}  Evictions: {stats['evictions']}",
+        ])
+
+
+def default_cache_root():
+    return os.path.join(os.path.expanduser("~"), ".lineageos_downloader", "artifacts")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect the LineageOS downloader artifact cache")
+    parser.add_argument("command", choices=["stats", "clear"])
+    parser.add_argument("--root", default=default_cache_root())
+    args = parser.parse_args()
+    cache = ArtifactCache(args.root)
+    if args.command == "clear":
+        for sha256 in list(cache.index['entries']):
+            cache.drop_entry(sha256)
+        cache.save_index()
+    print(cache.format_stats())
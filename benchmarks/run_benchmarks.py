@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.standin_server import StandinServer, ServerConditions, build_dataset
+
+MB = 1024 ** 2
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "baseline": {},
+    "latency": {'latency': 0.15},
+    "throttled": {'bandwidth': 40 * MB},
+    "flaky": {'drop_after': 8 * MB, 'drops': 1},
+    "no-ranges": {'ranges': False},
+}
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def folder_size(path):
+    total = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(folder, name))
+    return total
+
+
+def run_client(config):
+    # Runs in its own process so CPU time and peak RSS belong to the downloader alone
+    import lineageos_core
+    from lineageos_core import LineageOSCore
+    from events import ProgressTracker
+
+    base_url = config['base_url']
+    lineageos_core.BUILDS_API = base_url + "/api/v2/devices/{device}/builds"
+    lineageos_core.GAPPS_API = base_url + "/repos/MindTheGapps/{android_version}.0.0-{gapps_suffix}/releases/latest"
+    lineageos_core.PERMANENT_LINKS = config['permanent_links']
+
+    core = LineageOSCore(state_dir=config['state_dir'])
+    core.segment_count = config['segments']
+    core.retry_attempts = config['retries']
+
+    # Drain the event bus the way the CLI does, so its cost is part of the measurement
+    tracker = ProgressTracker()
+    done = threading.Event()
+
+    def drain():
+        while not done.wait(0.2):
+            tracker.apply(core.events.drain())
+
+    drainer = threading.Thread(target=drain, daemon=True)
+    drainer.start()
+
+    started = time.monotonic()
+    cpu_started = os.times()
+    plan = core.resolve_plan(config['device'], gapps=True)
+    core.create_folders_and_ini(plan, config['out_dir'])
+    resolved = time.monotonic()
+    ok = core.download_plan(plan, jobs=config['jobs'])
+    finished = time.monotonic()
+    cpu_finished = os.times()
+    done.set()
+    drainer.join()
+
+    # Children covers the ZIP check worker processes
+    cpu = sum(cpu_finished[:4]) - sum(cpu_started[:4])
+    downloaded = folder_size(plan.target_dir)
+    transfer = max(finished - resolved, 0.001)
+    return {
+        'ok': ok,
+        'failed': [os.path.basename(url) for url in core.failed_downloads],
+        'files': len(plan.urls),
+        'bytes': downloaded,
+        'resolve_seconds': resolved - started,
+        'transfer_seconds': transfer,
+        'total_seconds': finished - started,
+        'mb_per_s': downloaded / MB / transfer,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / (downloaded / 1024 ** 3) if downloaded else None,
+        'peak_rss_bytes': peak_rss(),
+        'phases': core.metrics.snapshot()['phases'],
+    }
+
+
+def run_scenario(server, name, args):
+    server.apply(ServerConditions(**SCENARIOS[name]))
+    work_dir = tempfile.mkdtemp(prefix=f"lineageos_bench_{name}_")
+    config = {
+        'base_url': server.base_url,
+        'permanent_links': server.permanent_links(),
+        'device': args.device,
+        'state_dir': os.path.join(work_dir, "state"),
+        'out_dir': os.path.join(work_dir, "out"),
+        'jobs': args.jobs,
+        'segments': args.segments,
+        'retries': args.retries,
+    }
+    os.makedirs(config['out_dir'])
+    try:
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run_benchmarks", "--client"],
+            input=json.dumps(config), capture_output=True, text=True, cwd=REPO_ROOT
+        )
+        if completed.returncode != 0:
+            return {'scenario': name, 'ok': False, 'error': completed.stderr.strip().splitlines()[-1:]}
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with server.lock:
+        result['server_bytes'] = server.bytes_sent
+        result['server_requests'] = sum(server.requests.values())
+    result['scenario'] = name
+    return result
+
+
+def format_row(result):
+    if 'error' in result:
+        return f"{result['scenario']:<12} error: {' '.join(result['error'])}"
+    rss = f"{result['peak_rss_bytes'] / MB:8.1f}" if result['peak_rss_bytes'] else "       -"
+    per_gb = f"{result['cpu_seconds_per_gb']:9.2f}" if result['cpu_seconds_per_gb'] is not None else "        -"
+    return (f"{result['scenario']:<12} {result['mb_per_s']:8.1f} {result['total_seconds']:8.2f} "
+            f"{result['cpu_seconds']:8.2f} {per_gb} {rss}  {'ok' if result['ok'] else 'FAILED'}")
+
+
+def compare(previous_path, results):
+    with open(previous_path, "r") as f:
+        previous = {result['scenario']: result for result in json.load(f)['results'] if 'error' not in result}
+    print(f"\nCompared with {previous_path}:")
+    for result in results:
+        before = previous.get(result['scenario'])
+        if not before or 'error' in result:
+            continue
+        speed = (result['mb_per_s'] / before['mb_per_s'] - 1) * 100
+        line = f"{result['scenario']:<12} MB/s {speed:+6.1f}%"
+        if result['cpu_seconds_per_gb'] and before['cpu_seconds_per_gb']:
+            cpu = (result['cpu_seconds_per_gb'] / before['cpu_seconds_per_gb'] - 1) * 100
+            line += f", CPU/GB {cpu:+6.1f}%"
+        print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=REPO_ROOT).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run_benchmarks",
+        description="Download a synthetic build from a local stand-in server and measure the downloader."
+    )
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--device", choices=["nx_tab", "nx"], default="nx_tab")
+    parser.add_argument("--zip-size", type=int, default=512, help="lineage zip size in MB")
+    parser.add_argument("--gapps-size", type=int, default=128, help="MindTheGapps zip size in MB")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "lineageos_bench_data"),
+                        help="where the synthetic build is generated and kept between runs")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", metavar="RESULTS", help="earlier results file to compare against")
+    parser.add_argument("--client", action="store_true", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.client:
+        print(json.dumps(run_client(json.load(sys.stdin))))
+        return 0
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    print(f"Preparing synthetic build in {args.data_dir}...")
+    manifest = build_dataset(args.data_dir, args.device, args.zip_size * MB, args.gapps_size * MB)
+    server = StandinServer(args.data_dir, manifest)
+    server.publish(args.device)
+    server.start()
+
+    results = []
+    print(f"{'scenario':<12} {'MB/s':>8} {'total s':>8} {'cpu s':>8} {'cpu s/GB':>9} {'RSS MB':>8}")
+    try:
+        for name in names:
+            for _ in range(args.repeat):
+                result = run_scenario(server, name, args)
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        server.stop()
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results",
+                                         time.strftime("bench-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': {key: value for key, value in vars(args).items() if key not in ("client", "compare", "output")},
+            'results': results,
+        }, f, indent=2)
+    print(f"Results saved to {output}")
+    if args.compare:
+        compare(args.compare, results)
+    return 0 if all(result.get('ok') for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import zipfile
+import socket
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+from scheduler import TokenBucket
+
+BUILD_VERSION = "22.1"
+ANDROID_VERSION = "15"  # What lineageos_core.ANDROID_VERSIONS maps BUILD_VERSION to
+BUILD_DATE = "2026-10-10"
+GAPPS_TAG = "20261001_120000"
+
+# name -> size in bytes; the lineage zip and GApps are real zips, the rest is random
+SMALL_FILES = {
+    "boot.img": 64 * 1024 ** 2,
+    "recovery.img": 64 * 1024 ** 2,
+    "nx-plat.dtimg": 512 * 1024,
+    "bl31.bin": 64 * 1024,
+    "bl33.bin": 1024 ** 2,
+    "boot.scr": 4 * 1024,
+    "super_empty.img": 8 * 1024,
+    "bootlogo_android.bmp": 2 * 1024 ** 2,
+    "icon_android_hue.bmp": 256 * 1024,
+}
+
+
+class ServerConditions:
+    # Changed between scenarios while the server keeps running
+    def __init__(self, latency=0.0, bandwidth=0, drop_after=0, drops=1, ranges=True):
+        self.latency = latency  # Seconds before every response
+        self.bandwidth = bandwidth  # Bytes per second across all file responses, 0 = unlimited
+        self.drop_after = drop_after  # Cut a file response after this many bytes, 0 = never
+        self.drops = drops  # Responses cut per file before it is served cleanly
+        self.ranges = ranges
+
+
+def write_random(path, size):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(remaining, 4 * 1024 ** 2))
+            f.write(block)
+            remaining -= len(block)
+
+
+def write_zip(path, size, member_size=16 * 1024 ** 2):
+    # Stored members of random data, so the zip is valid and as large as requested
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+        remaining = size
+        index = 0
+        while remaining > 0:
+            length = min(remaining, member_size)
+            archive.writestr(f"payload/{index:04d}.bin", os.urandom(length))
+            remaining -= length
+            index += 1
+
+
+def file_sha256(path):
+    sha256_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+
+def build_dataset(root, device, zip_size, gapps_size):
+    # Reused between runs as long as the requested sizes match
+    manifest_path = os.path.join(root, "manifest.json")
+    wanted = {'device': device, 'zip_size': zip_size, 'gapps_size': gapps_size}
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest['params'] == wanted and all(
+                os.path.getsize(os.path.join(root, name)) == info['size']
+                for name, info in manifest['files'].items()):
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+
+    os.makedirs(root, exist_ok=True)
+    compact_date = BUILD_DATE.replace("-", "")
+    zip_name = f"lineage-{BUILD_VERSION}-{compact_date}-nightly-{device}-signed.zip"
+    gapps_suffix = "arm64-ATV" if device == "nx" else "arm64"
+    gapps_name = f"MindTheGapps-{ANDROID_VERSION}.0.0-{gapps_suffix}-{GAPPS_TAG}.zip"
+
+    write_zip(os.path.join(root, zip_name), zip_size)
+    write_zip(os.path.join(root, gapps_name), gapps_size)
+    for name, size in SMALL_FILES.items():
+        write_random(os.path.join(root, name), size)
+
+    files = {}
+    for name in [zip_name, gapps_name] + list(SMALL_FILES):
+        path = os.path.join(root, name)
+        files[name] = {'size': os.path.getsize(path), 'sha256': file_sha256(path)}
+    manifest = {'params': wanted, 'zip_name': zip_name, 'gapps_name': gapps_name,
+                'android_version': ANDROID_VERSION, 'gapps_suffix': gapps_suffix, 'files': files}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        server = self.server
+        conditions = server.conditions
+        if conditions.latency:
+            time.sleep(conditions.latency)
+        path = urlsplit(self.path).path
+        server.count_request(path)
+        if path in server.json_routes:
+            self.send_json(server.json_routes[path], send_body)
+        elif path.startswith("/files/") and path[len("/files/"):] in server.manifest['files']:
+            self.send_file(path[len("/files/"):], send_body)
+        else:
+            self.send_error(404)
+
+    def send_json(self, body, send_body):
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def parse_range(self, size):
+        value = self.headers.get("Range", "")
+        if not value.startswith("bytes=") or "," in value:
+            return None
+        first, _, last = value[len("bytes="):].partition("-")
+        if not first:
+            return None
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        return (start, end) if start <= end else False
+
+    def send_file(self, name, send_body):
+        server = self.server
+        conditions = server.conditions
+        path = os.path.join(server.data_dir, name)
+        size = server.manifest['files'][name]['size']
+        byte_range = self.parse_range(size) if conditions.ranges else None
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", f'"{server.manifest["files"][name]["sha256"][:16]}"')
+        if conditions.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        cut_at = None
+        if conditions.drop_after and server.take_drop(name, conditions.drops):
+            cut_at = conditions.drop_after
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                block = f.read(min(remaining, 64 * 1024))
+                if not block:
+                    break
+                if cut_at is not None and sent + len(block) >= cut_at:
+                    self.wfile.write(block[:max(cut_at - sent, 0)])
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                server.bandwidth.consume(len(block))
+                self.wfile.write(block)
+                sent += len(block)
+                remaining -= len(block)
+                server.count_bytes(len(block))
+
+
+class StandinServer(ThreadingHTTPServer):
+    # Plays download.lineageos.org, the GitHub releases API and the file mirror at once
+    daemon_threads = True
+
+    def __init__(self, data_dir, manifest, address=("127.0.0.1", 0)):
+        super().__init__(address, StandinHandler)
+        self.data_dir = data_dir
+        self.manifest = manifest
+        self.conditions = ServerConditions()
+        self.bandwidth = TokenBucket(0)
+        self.lock = threading.Lock()
+        self.drops_taken = {}
+        self.requests = {}
+        self.bytes_sent = 0
+        self.json_routes = {}
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def builds_path(self, device):
+        return f"/api/v2/devices/{device}/builds"
+
+    def gapps_path(self):
+        return (f"/repos/MindTheGapps/{self.manifest['android_version']}.0.0-"
+                f"{self.manifest['gapps_suffix']}/releases/latest")
+
+    def publish(self, device):
+        files = []
+        for name, info in self.manifest['files'].items():
+            if name == self.manifest['gapps_name'] or name.endswith(".bmp"):
+                continue
+            files.append({'filename': name, 'url': f"{self.base_url}/files/{name}",
+                          'sha256': info['sha256'], 'size': info['size']})
+        builds = [{'date': BUILD_DATE, 'version': BUILD_VERSION, 'type': "nightly", 'files': files}]
+        gapps_name = self.manifest['gapps_name']
+        release = {'tag_name': GAPPS_TAG, 'assets': [{
+            'name': gapps_name,
+            'size': self.manifest['files'][gapps_name]['size'],
+            'browser_download_url': f"{self.base_url}/files/{gapps_name}",
+        }]}
+        self.json_routes = {
+            self.builds_path(device): json.dumps(builds).encode(),
+            self.gapps_path(): json.dumps(release).encode(),
+        }
+
+    def handle_error(self, request, client_address):
+        # Dropped connections are part of the scenarios; anything else is a bug here
+        if not isinstance(sys.exc_info()[1], OSError):
+            super().handle_error(request, client_address)
+
+    def permanent_links(self):
+        return [f"{self.base_url}/files/{name}" for name in self.manifest['files'] if name.endswith(".bmp")]
+
+    def apply(self, conditions):
+        with self.lock:
+            self.conditions = conditions
+            self.bandwidth = TokenBucket(conditions.bandwidth)
+            self.drops_taken = {}
+            self.requests = {}
+            self.bytes_sent = 0
+
+    def take_drop(self, name, limit):
+        with self.lock:
+            taken = self.drops_taken.get(name, 0)
+            if taken >= limit:
+                return False
+            self.drops_taken[name] = taken + 1
+            return True
+
+    def count_request(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def count_bytes(self, amount):
+        with self.lock:
+            self.bytes_sent += amount
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
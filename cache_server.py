@@ -0,0 +1,381 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import lineageos_core
+from artifact_cache import ArtifactCache
+from metadata_cache import MetadataCache
+from chunk_reader import AdaptiveChunkReader, write_all
+from file_utils import write_json_atomic
+
+FAR_AHEAD = 16 * 1024 * 1024  # A range starting this far past the shared fetch is fetched on its own
+SEND_BLOCK = 1024 * 1024
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def plain_digest(value):
+    # Digests become file names under incoming/ and the cache, so anything else is dropped
+    return value if isinstance(value, str) and SHA256_PATTERN.fullmatch(value) else None
+
+
+def metadata_patterns():
+    # Read at call time so tools that point the core at other APIs are followed here too.
+    # A placeholder matches one plain path segment, so dot segments, encoded slashes and
+    # extra path or query parts never match; requests would normalize them after the check.
+    patterns = []
+    for template in (lineageos_core.BUILDS_API, lineageos_core.GAPPS_API):
+        parts = re.split(r"\{\w+\}", template)
+        patterns.append(re.compile("[A-Za-z0-9_-]+".join(re.escape(part) for part in parts)))
+    return patterns
+
+
+class SharedFetch:
+    # One upstream download into incoming/<sha256>; any number of clients
+    # read the file while it grows
+    def __init__(self, url, sha256, path):
+        self.url = url
+        self.sha256 = sha256
+        self.path = path
+        self.condition = threading.Condition()
+        self.size = None
+        self.ranges = False
+        self.written = 0
+        self.finished = False
+        self.error = None
+        self.readers = 0
+
+    def update(self, **fields):
+        with self.condition:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.condition.notify_all()
+
+    def advance(self, amount):
+        with self.condition:
+            self.written += amount
+            self.condition.notify_all()
+
+    def wait_started(self, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.size is not None or self.finished, timeout)
+            return self.size
+
+    def wait_for(self, position, timeout):
+        # Bytes on disk once position is readable, the fetch ended or timeout passed
+        with self.condition:
+            self.condition.wait_for(lambda: self.written > position or self.finished, timeout)
+            return self.written
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug(f"{self.client_address[0]} {format % args}")
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        url = query.get('url', [None])[0]
+        if not parts.path.startswith("/fetch") or not url:
+            self.send_error(404)
+            return
+        if not server.allowed(url):
+            self.send_error(403, "Only build API, MindTheGapps and their file URLs are served")
+            return
+        try:
+            if server.is_metadata(url):
+                self.send_metadata(url, send_body)
+                return
+            sha256 = query.get('sha256', [None])[0]
+            known = server.known.get(url)
+            # The digest names files under incoming/ and the cache, so only a plain sha256 is accepted,
+            # and one learned from proxied metadata wins over whatever the client sent
+            if sha256 is not None and (not SHA256_PATTERN.fullmatch(sha256) or (known and sha256 != known)):
+                self.send_error(400, "sha256 must be the file's 64-digit lowercase hex digest")
+                return
+            sha256 = known or sha256
+            path = server.cache.lookup(sha256) if sha256 else None
+            if path:
+                server.cache.touch(sha256)
+                self.send_cached(path, sha256, send_body)
+            elif sha256:
+                self.send_shared(url, sha256, send_body)
+            else:
+                # Nothing to check the bytes against, so they are passed on but never stored
+                self.send_passthrough(url, send_body)
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Upstream request for {url} failed: {e}")
+            self.send_error(502, str(e))
+
+    def send_metadata(self, url, send_body):
+        server = self.server
+        headers = {'Accept': self.headers['Accept']} if self.headers.get('Accept') else None
+        body = server.metadata.get_json(server.session, url, headers=headers, timeout=server.timeout)
+        server.learn(body)
+        data = json.dumps(body).encode("utf-8")
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def parse_range(self, size):
+        value = self.headers.get("Range", "")
+        if not value.startswith("bytes=") or "," in value:
+            return None
+        first, _, last = value[len("bytes="):].partition("-")
+        if not first:
+            return None
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        return (start, end) if start <= end else False
+
+    def start_response(self, size, sha256, byte_range):
+        # Sends the headers; returns the (start, end) to send, or None after a 416
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{sha256}"')
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        return start, end
+
+    def send_cached(self, path, sha256, send_body):
+        size = os.path.getsize(path)
+        byte_range = self.start_response(size, sha256, self.parse_range(size))
+        if byte_range is None or not send_body:
+            return
+        start, end = byte_range
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                block = f.read(min(remaining, SEND_BLOCK))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def send_shared(self, url, sha256, send_body):
+        server = self.server
+        fetch = server.shared_fetch(url, sha256)
+        try:
+            size = fetch.wait_started(server.timeout[1])
+            if size is None:
+                # Upstream gave no usable answer to the shared fetch; try this request on its own
+                self.send_passthrough(url, send_body)
+                return
+            byte_range = self.parse_range(size)
+            if byte_range and fetch.ranges and byte_range[0] > fetch.written + FAR_AHEAD:
+                # e.g. a zip's central directory; waiting for the whole file would stall the client
+                self.send_passthrough(url, send_body)
+                return
+            byte_range = self.start_response(size, sha256, byte_range)
+            if byte_range is None or not send_body:
+                return
+            position, end = byte_range
+            with open(fetch.path, "rb") as f:
+                while position <= end:
+                    available = fetch.wait_for(position, server.timeout[1])
+                    if available <= position:
+                        # Upstream failed or stalled; a short body makes the client retry
+                        self.close_connection = True
+                        return
+                    f.seek(position)
+                    block = f.read(min(available - position, end - position + 1, SEND_BLOCK))
+                    self.wfile.write(block)
+                    position += len(block)
+        finally:
+            server.release(fetch)
+
+    def send_passthrough(self, url, send_body):
+        server = self.server
+        headers = {'Accept-Encoding': 'identity'}
+        if self.headers.get("Range"):
+            headers['Range'] = self.headers["Range"]
+        method = server.session.get if send_body else server.session.head
+        with method(url, headers=headers, stream=True, timeout=server.timeout, allow_redirects=True) as response:
+            self.send_response(response.status_code)
+            for name in ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag",
+                         "Last-Modified"):
+                if name in response.headers:
+                    self.send_header(name, response.headers[name])
+            self.end_headers()
+            if send_body:
+                for chunk in AdaptiveChunkReader(response):
+                    self.wfile.write(chunk)
+
+
+class CacheServer(ThreadingHTTPServer):
+    # LAN cache for other downloader instances: metadata is revalidated
+    # through a MetadataCache, files with a known sha256 are fetched once and
+    # streamed to every client asking for them meanwhile, then stored in an
+    # ArtifactCache (evicting least recently used builds at the quota) only
+    # if the hash matches.
+    daemon_threads = True
+
+    def __init__(self, root, max_bytes, address=("0.0.0.0", 8080)):
+        super().__init__(address, CacheHandler)
+        self.root = root
+        self.cache = ArtifactCache(os.path.join(root, "artifacts"), max_bytes=max_bytes)
+        self.metadata = MetadataCache(os.path.join(root, "metadata"), fresh_for=60)
+        self.incoming = os.path.join(root, "incoming")
+        shutil.rmtree(self.incoming, ignore_errors=True)  # Unverified leftovers of an earlier run
+        os.makedirs(self.incoming, exist_ok=True)
+        self.session = requests.Session()
+        self.timeout = (10, 60)
+        self.retry_attempts = 3
+        self.lock = threading.Lock()
+        self.fetches = {}  # sha256 -> SharedFetch in progress
+        self.known_path = os.path.join(root, "known_files.json")
+        self.known = self.load_known()  # url -> sha256 (or None) learned from proxied metadata
+
+    def load_known(self):
+        try:
+            with open(self.known_path, "r") as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = {}
+        known = {url: plain_digest(sha256) for url, sha256 in known.items()}
+        for url in lineageos_core.PERMANENT_LINKS:
+            known.setdefault(url, None)
+        return known
+
+    def save_known(self):
+        write_json_atomic(self.known_path, self.known)
+
+    def learn(self, body):
+        # Build API lists carry each file's sha256; GitHub assets may carry a "sha256:..." digest
+        files = {}
+        if isinstance(body, list):
+            for build in body:
+                for file in build.get('files', []):
+                    if file.get('url'):
+                        files[file['url']] = file.get('sha256')
+        elif isinstance(body, dict):
+            for asset in body.get('assets', []):
+                digest = asset.get('digest') or ""
+                if asset.get('browser_download_url'):
+                    files[asset['browser_download_url']] = digest[7:] if digest.startswith("sha256:") else None
+        files = {url: plain_digest(sha256) for url, sha256 in files.items()}
+        with self.lock:
+            changed = {url: sha256 for url, sha256 in files.items() if self.known.get(url, "") != sha256}
+            if changed:
+                self.known.update(changed)
+                self.save_known()
+
+    def is_metadata(self, url):
+        return any(pattern.fullmatch(url) for pattern in metadata_patterns())
+
+    def allowed(self, url):
+        # Not an open proxy: only the APIs and files they listed
+        return url in self.known or self.is_metadata(url)
+
+    def shared_fetch(self, url, sha256):
+        with self.lock:
+            fetch = self.fetches.get(sha256)
+            if fetch is None:
+                fetch = SharedFetch(url, sha256, os.path.join(self.incoming, sha256))
+                self.fetches[sha256] = fetch
+                threading.Thread(target=self.run_fetch, args=(fetch,), daemon=True).start()
+            fetch.readers += 1
+        return fetch
+
+    def release(self, fetch):
+        with self.lock:
+            fetch.readers -= 1
+            self.discard_if_unused(fetch)
+
+    def discard_if_unused(self, fetch):
+        # Caller holds the lock; the incoming file goes once the fetch ended and nobody reads it
+        if fetch.finished and fetch.readers == 0 and self.fetches.get(fetch.sha256) is not fetch:
+            try:
+                os.remove(fetch.path)
+            except OSError:
+                pass
+
+    def run_fetch(self, fetch):
+        filename = lineageos_core.url_filename(fetch.url)
+        hasher = hashlib.sha256()
+        try:
+            with open(fetch.path, "wb", buffering=0) as f:
+                for attempt in range(1, self.retry_attempts + 1):
+                    try:
+                        self.fetch_into(fetch, f, hasher)
+                        break
+                    except (requests.RequestException, OSError) as e:
+                        # Clients already have the leading bytes, so only a resumed stream can continue
+                        if attempt == self.retry_attempts or not fetch.ranges:
+                            raise
+                        logging.warning(f"Upstream fetch of {filename} failed at {fetch.written} bytes: {e}")
+            if fetch.written != fetch.size:
+                raise ValueError(f"Upstream ended {filename} at {fetch.written} of {fetch.size} bytes")
+            if hasher.hexdigest() != fetch.sha256:
+                raise ValueError(f"Checksum mismatch for {filename}; not stored")
+            if self.cache.add(fetch.sha256, fetch.path, url=fetch.url):
+                logging.info(f"Stored {filename} ({lineageos_core.format_size(fetch.size)})")
+        except Exception as e:
+            logging.warning(f"Shared fetch of {filename} failed: {e}")
+            fetch.update(error=str(e))
+        finally:
+            with self.lock:
+                self.fetches.pop(fetch.sha256, None)
+                fetch.update(finished=True)
+                self.discard_if_unused(fetch)
+
+    def fetch_into(self, fetch, f, hasher):
+        headers = {'Accept-Encoding': 'identity'}
+        if fetch.written:
+            headers['Range'] = f"bytes={fetch.written}-"
+        with self.session.get(fetch.url, headers=headers, stream=True, timeout=self.timeout,
+                              allow_redirects=True) as response:
+            response.raise_for_status()
+            if fetch.written and response.status_code != 206:
+                raise ValueError("upstream did not resume the transfer")
+            if fetch.size is None:
+                if 'Content-Length' not in response.headers:
+                    raise ValueError("upstream did not report a size")
+                fetch.update(size=int(response.headers['Content-Length']),
+                             ranges=response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+            for chunk in AdaptiveChunkReader(response):
+                write_all(f, chunk)
+                hasher.update(chunk)
+                fetch.advance(len(chunk))
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-transfer all the time (cancel, retry, mirror failover)
+        if not isinstance(sys.exc_info()[1], OSError):
+            super().handle_error(request, client_address)
@@ -0,0 +1,51 @@
+import time
+
+
+def write_all(f, data):
+    # Unbuffered files may accept only part of a large write
+    while data:
+        written = f.write(data)
+        data = data[written:]
+
+
+class AdaptiveChunkReader:
+    # Reads a streamed response into one preallocated buffer. The read size
+    # doubles while reads come back quickly and halves when one takes longer
+    # than slow_read, so fast links need few Python-level iterations and slow
+    # ones still report progress and notice cancellation promptly.
+    def __init__(self, response, min_size=16 * 1024, max_size=1024 * 1024,
+                 fast_read=0.02, slow_read=0.25):
+        self.response = response
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.size = min(max(64 * 1024, self.min_size), self.max_size)
+        self.fast_read = fast_read
+        self.slow_read = slow_read
+        self.buffer = bytearray(self.max_size)
+        self.view = memoryview(self.buffer)
+        encoding = response.headers.get('Content-Encoding', 'identity').lower()
+        # Raw reads skip requests' decoding, so compressed bodies take the slow path
+        self.direct = encoding in ("", "identity") and hasattr(response.raw, 'readinto')
+
+    def adapt(self, received, elapsed):
+        if received == self.size and elapsed < self.fast_read:
+            self.size = min(self.size * 2, self.max_size)
+        elif elapsed > self.slow_read:
+            self.size = max(self.size // 2, self.min_size)
+
+    def __iter__(self):
+        # Yielded views point into the shared buffer and are only valid until the next step
+        if not self.direct:
+            for chunk in self.response.iter_content(chunk_size=self.size):
+                if chunk:
+                    yield memoryview(chunk)
+            return
+        readinto = self.response.raw.readinto
+        while True:
+            started = time.monotonic()
+            received = readinto(self.view[:self.size])
+            if not received:
+                return
+            elapsed = time.monotonic() - started
+            yield self.view[:received]
+            self.adapt(received, elapsed)
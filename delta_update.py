@@ -0,0 +1,151 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import DownloadCanceled
+from zip_structure import (read_directory, entry_regions, local_header_length,
+                           LOCAL_HEADER_SIZE, ZipFormatError)
+
+
+class DeltaUpdater:
+    # Rebuilds a new build's zip from the previous one. The new central directory
+    # is read over HTTP Range requests; members whose name, method, CRC and sizes
+    # are unchanged are copied from the old zip and everything else is fetched.
+    def __init__(self, core, header_slack=256, min_reuse=0.05):
+        self.core = core
+        self.header_slack = header_slack  # Extra bytes fetched to cover local extra fields
+        self.min_reuse = min_reuse  # Skip the delta when less than this share can be reused
+        self.progress_path = None  # File the rebuilt bytes are reported against
+
+    def remote_read(self, url, offset, length):
+        headers = {"Range": f"bytes={offset}-{offset + length - 1}"}
+        with self.core.open_stream(url, headers) as response:
+            if response.status_code != 206:
+                raise ValueError("Server ignored range request")
+            data = response.content
+        self.core.bandwidth.consume(len(data), self.core.is_canceled)
+        if len(data) != length:
+            raise ValueError(f"Short range read at {offset}: {len(data)} of {length} bytes")
+        return data
+
+    def build(self, url, remote_size, previous_zip, out_path, progress_path=None):
+        self.progress_path = progress_path
+        remote = read_directory(lambda offset, length: self.remote_read(url, offset, length), remote_size)
+        with open(previous_zip, "rb") as old:
+            def local_read(offset, length):
+                old.seek(offset)
+                return old.read(length)
+            local = read_directory(local_read, os.path.getsize(previous_zip))
+            operations, reused = self.plan_operations(url, remote, local, local_read)
+        if reused < remote_size * self.min_reuse:
+            self.core.log_message(f"Delta update skipped: only {reused * 100 // remote_size}% of the new zip is reusable")
+            return None
+
+        hasher = hashlib.sha256()
+        written = 0
+        with open(previous_zip, "rb") as old, open(out_path, "wb") as out:
+            for kind, first, second in operations:
+                if kind == "bytes":
+                    out.write(first)
+                    hasher.update(first)
+                    written += len(first)
+                    self.report_written(len(first))
+                elif kind == "local":
+                    written += self.copy_local(old, first, second, out, hasher)
+                else:
+                    written += self.copy_remote(url, first, second, out, hasher)
+        if written != remote_size:
+            raise ZipFormatError(f"Rebuilt {written} bytes, expected {remote_size}")
+        return hasher.hexdigest(), reused, remote_size - reused
+
+    def plan_operations(self, url, remote, local, local_read):
+        old_entries = local.by_name()
+        regions = entry_regions(remote)
+        reusable = [(entry, start, end) for entry, start, end in regions
+                    if entry.name in old_entries and old_entries[entry.name].signature() == entry.signature()]
+
+        # Local headers of reused members still come from the server: their
+        # timestamps and extra fields have to match the new zip byte for byte
+        def fetch_header(region):
+            entry, start, end = region
+            length = min(LOCAL_HEADER_SIZE + len(entry.name.encode("utf-8")) + self.header_slack, end - start)
+            header = self.remote_read(url, start, length)
+            header_length = local_header_length(header)
+            if header_length > len(header):
+                header += self.remote_read(url, start + len(header), header_length - len(header))
+            return header[:header_length]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            headers = dict(zip((start for _, start, _ in reusable), executor.map(fetch_header, reusable)))
+
+        operations = []
+        reused = 0
+        first_member = regions[0][1] if regions else remote.cd_offset
+        if first_member:
+            operations.append(("remote", 0, first_member))
+        for entry, start, end in regions:
+            if start not in headers:
+                operations.append(("remote", start, end))
+                continue
+            header = headers[start]
+            previous = old_entries[entry.name]
+            old_data = previous.header_offset + local_header_length(
+                local_read(previous.header_offset, LOCAL_HEADER_SIZE))
+            operations.append(("bytes", header, None))
+            operations.append(("local", old_data, entry.compressed_size))
+            reused += entry.compressed_size
+            data_end = start + len(header) + entry.compressed_size
+            if data_end < end:
+                operations.append(("remote", data_end, end))
+        operations.append(("bytes", remote.tail, None))
+        return self.merge(operations), reused
+
+    def merge(self, operations):
+        merged = []
+        for operation in operations:
+            if (merged and operation[0] == "remote" and merged[-1][0] == "remote"
+                    and merged[-1][2] == operation[1]):
+                merged[-1] = ("remote", merged[-1][1], operation[2])
+            else:
+                merged.append(operation)
+        return merged
+
+    def report_written(self, amount):
+        if self.progress_path:
+            self.core.report_progress(self.progress_path, amount)
+
+    def copy_local(self, old, offset, length, out, hasher):
+        old.seek(offset)
+        remaining = length
+        while remaining:
+            if self.core.cancel_download:
+                raise DownloadCanceled()
+            data = old.read(min(remaining, 1024 * 1024))
+            if not data:
+                raise ZipFormatError(f"Previous zip ended early at {offset + length - remaining}")
+            out.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+            self.report_written(len(data))
+        return length
+
+    def copy_remote(self, url, start, end, out, hasher):
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        received = 0
+        with self.core.open_stream(url, headers) as response:
+            if response.status_code != 206:
+                raise ValueError("Server ignored range request")
+            for chunk in response.iter_content(chunk_size=65536):
+                if self.core.cancel_download:
+                    raise DownloadCanceled()
+                chunk = chunk[:end - start - received]
+                out.write(chunk)
+                hasher.update(chunk)
+                received += len(chunk)
+                self.report_written(len(chunk))
+                self.core.bandwidth.consume(len(chunk), self.core.is_canceled)
+                if received >= end - start:
+                    break
+        if received != end - start:
+            raise ValueError(f"Range {start}-{end - 1} ended early after {received} bytes")
+        return received
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS plans (
+    run_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    device TEXT NOT NULL,
+    build TEXT NOT NULL,
+    gapps_url TEXT,
+    gapps_filename TEXT,
+    gapps_size INTEGER,
+    target_dir TEXT NOT NULL,
+    PRIMARY KEY (run_id, position)
+);
+CREATE TABLE IF NOT EXISTS files (
+    run_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    url TEXT NOT NULL,
+    plan_position INTEGER NOT NULL,
+    size INTEGER,
+    state TEXT NOT NULL,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (run_id, path)
+);
+"""
+
+FINISHED_STATES = ("done", "cached", "exists", "shared")
+
+
+class DownloadJournal:
+    # SQLite record of the current run: its plans, every file's state, bytes
+    # received and verified hashes. State changes commit at once; byte counts
+    # are batched and committed every checkpoint_interval seconds. WAL with
+    # synchronous=FULL fsyncs on each commit, so a crash loses at most one
+    # checkpoint of progress counters and never a finished file.
+    def __init__(self, path, checkpoint_interval=2.0):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+        self.connection = None
+        self.run_id = None
+        self.pending_bytes = {}
+        self.checkpointed_at = 0
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=FULL")
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def begin_run(self, plans):
+        # A run for the same set of files continues the unfinished one instead of starting over
+        files = []
+        for position, plan in enumerate(plans):
+            for url, path in plan.file_paths():
+                files.append((os.path.abspath(path), url, position, plan.sizes.get(url)))
+        with self.lock:
+            db = self.connect()
+            self.pending_bytes = {}
+            row = db.execute("SELECT id FROM runs WHERE status NOT IN ('complete', 'superseded') "
+                             "ORDER BY id DESC LIMIT 1").fetchone()
+            if row and set(path for path, _, _, _ in files) == set(
+                    path for (path,) in db.execute("SELECT path FROM files WHERE run_id = ?", row)):
+                self.run_id = row[0]
+                with db:
+                    db.execute("UPDATE runs SET status = 'active', updated = ? WHERE id = ?", (time.time(), self.run_id))
+                return self.run_id
+            now = time.time()
+            with db:
+                db.execute("UPDATE runs SET status = 'superseded' WHERE status != 'complete'")
+                self.run_id = db.execute("INSERT INTO runs (created, updated, status) VALUES (?, ?, 'active')",
+                                         (now, now)).lastrowid
+                db.executemany(
+                    "INSERT INTO plans VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(self.run_id, position, plan.device, json.dumps(plan.build), plan.gapps_url,
+                      plan.gapps_filename, plan.sizes.get(plan.gapps_url), plan.target_dir)
+                     for position, plan in enumerate(plans)]
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, 'pending', 0, NULL, ?)",
+                    [(self.run_id, path, url, position, size, now) for path, url, position, size in files]
+                )
+            return self.run_id
+
+    def file_started(self, path, total, done):
+        with self.lock:
+            if self.run_id is None:
+                return
+            self.pending_bytes.pop(os.path.abspath(path), None)
+            with self.connect() as db:
+                db.execute(
+                    "UPDATE files SET state = 'downloading', size = COALESCE(?, size), bytes_done = ?, updated = ? "
+                    "WHERE run_id = ? AND path = ?",
+                    (total or None, done, time.time(), self.run_id, os.path.abspath(path))
+                )
+
+    def file_progress(self, path, amount):
+        with self.lock:
+            if self.run_id is None:
+                return
+            key = os.path.abspath(path)
+            self.pending_bytes[key] = self.pending_bytes.get(key, 0) + amount
+            if time.monotonic() - self.checkpointed_at >= self.checkpoint_interval:
+                self.flush_progress()
+
+    def flush_progress(self):
+        # Caller holds the lock
+        self.checkpointed_at = time.monotonic()
+        if not self.pending_bytes:
+            return
+        now = time.time()
+        with self.connect() as db:
+            db.executemany(
+                "UPDATE files SET bytes_done = bytes_done + ?, updated = ? WHERE run_id = ? AND path = ?",
+                [(amount, now, self.run_id, path) for path, amount in self.pending_bytes.items()]
+            )
+        self.pending_bytes = {}
+
+    def file_finished(self, path, status, sha256=None):
+        with self.lock:
+            if self.run_id is None:
+                return
+            key = os.path.abspath(path)
+            self.pending_bytes.pop(key, None)
+            with self.connect() as db:
+                db.execute(
+                    "UPDATE files SET state = ?, sha256 = COALESCE(?, sha256), "
+                    "bytes_done = CASE WHEN ? THEN COALESCE(size, bytes_done) ELSE bytes_done END, updated = ? "
+                    "WHERE run_id = ? AND path = ?",
+                    (status, sha256, status in FINISHED_STATES, time.time(), self.run_id, key)
+                )
+
+    def finish_run(self, status):
+        with self.lock:
+            if self.run_id is None:
+                return
+            self.flush_progress()
+            with self.connect() as db:
+                db.execute("UPDATE runs SET status = ?, updated = ? WHERE id = ?", (status, time.time(), self.run_id))
+            self.run_id = None
+
+    def unfinished_run(self, include_failed=False):
+        # (run row, plan rows, file rows) of the newest run that was cut short, or None. A run
+        # that ended with failures only comes back when asked for, e.g. by --resume
+        statuses = ('active', 'canceled', 'failed') if include_failed else ('active', 'canceled')
+        with self.lock:
+            db = self.connect()
+            run = db.execute(f"SELECT id, created, status FROM runs WHERE status IN ({', '.join('?' * len(statuses))}) "
+                             "ORDER BY id DESC LIMIT 1", statuses).fetchone()
+            if not run:
+                return None
+            plans = db.execute("SELECT position, device, build, gapps_url, gapps_filename, gapps_size, target_dir "
+                               "FROM plans WHERE run_id = ? ORDER BY position", (run[0],)).fetchall()
+            files = db.execute("SELECT path, url, plan_position, size, state, bytes_done, sha256 "
+                               "FROM files WHERE run_id = ?", (run[0],)).fetchall()
+        return run, plans, files
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
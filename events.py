@@ -0,0 +1,119 @@
+import time
+from collections import deque
+
+COMPLETE = ("done", "cached", "exists", "shared")
+
+
+class EventBus:
+    # Workers only append; the UI (or console) drains on its own tick.
+    # deque.append and deque.popleft are atomic, so no lock is needed.
+    def __init__(self):
+        self.queue = deque()
+
+    def post(self, kind, **fields):
+        fields['kind'] = kind
+        fields['time'] = time.monotonic()
+        self.queue.append(fields)
+
+    def drain(self):
+        events = []
+        while True:
+            try:
+                events.append(self.queue.popleft())
+            except IndexError:
+                return events
+
+
+class ProgressTracker:
+    # Folds drained events into per-file rows plus overall bytes, speed and ETA
+    def __init__(self, window=5.0):
+        self.window = window
+        self.files = {}
+        self.order = []
+        self.transferred = 0  # Bytes received this run, excluding resumed offsets
+        self.samples = deque()
+
+    def reset(self):
+        self.__init__(self.window)
+
+    def row(self, key, name=None):
+        if key not in self.files:
+            self.files[key] = {'name': name or key, 'total': 0, 'done': 0, 'status': "queued"}
+            self.order.append(key)
+        elif name:
+            self.files[key]['name'] = name
+        return self.files[key]
+
+    def apply(self, events):
+        # Returns the log messages and any other events the caller has to act on
+        messages = []
+        other = []
+        for event in events:
+            kind = event['kind']
+            if kind == 'log':
+                messages.append(event['message'])
+            elif kind == 'plan':
+                for key, name, size in event['files']:
+                    self.row(key, name)['total'] = size or 0
+            elif kind == 'file_start':
+                row = self.row(event['file'], event.get('name'))
+                row['total'] = event.get('total') or row['total']
+                row['done'] = event.get('done', 0)
+                row['status'] = "downloading"
+            elif kind == 'bytes':
+                row = self.row(event['file'])
+                row['done'] += event['amount']
+                self.transferred += event['amount']
+            elif kind == 'file_done':
+                row = self.row(event['file'], event.get('name'))
+                row['status'] = event['status']
+                if event['status'] in COMPLETE:
+                    row['total'] = row['total'] or row['done']
+                    row['done'] = row['total']
+            else:
+                other.append(event)
+        now = time.monotonic()
+        self.samples.append((now, self.transferred))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        return messages, other
+
+    def totals(self):
+        done = sum(min(row['done'], row['total']) if row['total'] else row['done'] for row in self.files.values())
+        total = sum(row['total'] for row in self.files.values())
+        return done, total
+
+    def speed(self):
+        if len(self.samples) < 2:
+            return 0.0
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def eta(self):
+        done, total = self.totals()
+        speed = self.speed()
+        if not total or speed <= 0 or done >= total:
+            return None
+        return (total - done) / speed
+
+    def percent(self):
+        done, total = self.totals()
+        return done / total * 100 if total else 0.0
+
+    def completed_files(self):
+        return sum(1 for row in self.files.values() if row['status'] in COMPLETE)
+
+    def rows(self):
+        for key in self.order:
+            row = self.files[key]
+            percent = row['done'] / row['total'] * 100 if row['total'] else 0.0
+            yield key, row['name'], min(percent, 100.0), row['status']
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
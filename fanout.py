@@ -0,0 +1,205 @@
+import os
+import time
+import queue
+import threading
+
+from chunk_reader import write_all
+from sd_staging import BlockWriter, preallocate
+from verifier import hash_file
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def copy_range(source, f, start, end, block_size=4 * 1024 * 1024, on_write=None):
+    source.seek(start)
+    writer = BlockWriter(f, start, block_size, on_write or (lambda offset, data, seconds: None))
+    copied = 0
+    while start + copied < end:
+        data = source.read(min(block_size, end - start - copied))
+        if not data:
+            break
+        writer.write(data)
+        copied += len(data)
+    writer.flush()
+    return copied
+
+
+class FanOutTarget:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_file_path = file_path + ".part"
+        self.queue = queue.Queue()
+        self.queued = 0  # Bytes waiting for the writer thread
+        self.lock = threading.Lock()
+        self.written = []  # [start, end) ranges that reached the file from the stream
+        self.dropped = []  # Ranges skipped while the writer was behind
+        self.streamed = 0
+        self.error = None
+        self.thread = None
+
+    def add_written(self, start, end):
+        # Segments write sequentially, so extending the range that ends here keeps the list short
+        for written in self.written:
+            if written[1] == start:
+                written[1] = end
+                return
+        self.written.append([start, end])
+
+    def missing(self, size):
+        ranges = []
+        position = 0
+        for start, end in merge_ranges(self.written):
+            if start > position:
+                ranges.append((position, min(start, size)))
+            position = max(position, end)
+        if position < size:
+            ranges.append((position, size))
+        ranges.extend(self.dropped)
+        return [(start, end) for start, end in merge_ranges(ranges) if start < size]
+
+
+class FanOutWriter:
+    # Writes one download stream into further copies of the file, e.g. on
+    # several SD cards. Every target has its own writer thread and a bounded
+    # byte queue; a target that falls behind skips stream chunks instead of
+    # stalling the download, and finish_target copies what it missed from the
+    # local file before the copy is hashed. With block_size (SD card staging)
+    # stream chunks are gathered into aligned blocks, and on_write(path,
+    # amount, seconds) hears about every write.
+    def __init__(self, file_paths, total_size=None, preallocate_files=False, max_queued=64 * 1024 * 1024,
+                 block_size=None, on_write=None):
+        self.targets = [FanOutTarget(path) for path in file_paths]
+        self.total_size = total_size
+        self.preallocate_files = preallocate_files
+        self.max_queued = max_queued
+        self.block_size = block_size
+        self.on_write = on_write
+
+    def start(self):
+        for target in self.targets:
+            try:
+                os.makedirs(os.path.dirname(target.file_path), exist_ok=True)
+                f = open(target.temp_file_path, 'wb', buffering=0)
+                if self.preallocate_files and self.total_size:
+                    preallocate(f, self.total_size)
+            except OSError as e:
+                target.error = e
+                continue
+            target.thread = threading.Thread(target=self.run, args=(target, f), daemon=True)
+            target.thread.start()
+
+    def write(self, offset, data):
+        shared = None
+        for target in self.targets:
+            if target.error or target.thread is None:
+                continue
+            with target.lock:
+                if target.queued + len(data) > self.max_queued:
+                    target.dropped.append((offset, offset + len(data)))
+                    continue
+                target.queued += len(data)
+            if shared is None:
+                shared = bytes(data)  # The reader reuses its buffer, so the queues get one copy
+            target.queue.put((offset, shared))
+
+    def run(self, target, f):
+        writers = []  # One BlockWriter per contiguous run of the stream, e.g. per segment
+        with f:
+            while True:
+                item = target.queue.get()
+                if item is None:
+                    break
+                offset, data = item
+                try:
+                    if target.error is None:
+                        self.write_at(target, f, writers, offset, data)
+                except OSError as e:
+                    target.error = e  # e.g. the card was pulled; the rest of the queue is discarded
+                with target.lock:
+                    target.queued -= len(data)
+            try:
+                for writer in writers:
+                    if target.error is None:
+                        writer.flush()
+            except OSError as e:
+                target.error = e
+
+    def write_at(self, target, f, writers, offset, data):
+        if not self.block_size:
+            started = time.monotonic()
+            f.seek(offset)
+            write_all(f, data)
+            self.written(target, offset, data, time.monotonic() - started)
+            return
+        for writer in writers:
+            if writer.offset + writer.filled == offset:
+                writer.write(data)
+                return
+        writer = BlockWriter(f, offset, self.block_size,
+                             lambda position, block, seconds: self.written(target, position, block, seconds))
+        writers.append(writer)
+        writer.write(data)
+
+    def written(self, target, offset, data, seconds):
+        with target.lock:
+            target.add_written(offset, offset + len(data))
+            target.streamed += len(data)
+        if self.on_write:
+            self.on_write(target.temp_file_path, len(data), seconds)
+
+    def close(self):
+        for target in self.targets:
+            if target.thread is not None:
+                target.queue.put(None)
+        for target in self.targets:
+            if target.thread is not None:
+                target.thread.join()
+                target.thread = None
+
+    def finish_target(self, target, source_path, expected_checksum, sync=None):
+        # Fills the gaps from source_path, then hashes the bytes on the target itself
+        if target.error:
+            raise target.error
+        size = os.path.getsize(source_path)
+        temp_file_path = target.temp_file_path
+        copied = self.copy_from(source_path, temp_file_path, target.missing(size), size, sync)
+        result = hash_file(temp_file_path)
+        if result['sha256'] != expected_checksum:
+            # Bytes from a failed attempt or an old .part; rewrite the whole file once
+            copied += self.copy_from(source_path, temp_file_path, [(0, size)], size, sync)
+            result = hash_file(temp_file_path)
+        if result['error']:
+            raise OSError(result['error'])
+        if result['sha256'] != expected_checksum:
+            raise ValueError(f"Checksum mismatch for {target.file_path}")
+        os.replace(temp_file_path, target.file_path)
+        return copied
+
+    def copy_from(self, source_path, temp_file_path, ranges, size, sync=None):
+        copied = 0
+        os.makedirs(os.path.dirname(temp_file_path), exist_ok=True)
+        with open(source_path, 'rb') as source, \
+                open(temp_file_path, 'r+b' if os.path.exists(temp_file_path) else 'wb') as f:
+            if self.preallocate_files:
+                preallocate(f, size)
+            for start, end in ranges:
+                copied += copy_range(source, f, start, end, self.block_size or 4 * 1024 * 1024,
+                                     self.block_reporter(temp_file_path))
+            f.truncate(size)
+            f.flush()
+            if sync:
+                sync(temp_file_path, f)
+        return copied
+
+    def block_reporter(self, temp_file_path):
+        if self.on_write:
+            return lambda offset, data, seconds: self.on_write(temp_file_path, len(data), seconds)
+        return None
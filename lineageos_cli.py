@@ -0,0 +1,337 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+
+from lineageos_core import (LineageOSCore, DEVICES, DEVICE_ALIASES, APP_VERSION,
+                            resolve_device, configure_logging, format_size)
+from events import EventBus, ProgressTracker, format_eta
+from metrics import serve_metrics
+from watcher import BuildWatcher, lower_priority
+from cache_server import CacheServer
+
+COMMANDS = ["download", "verify", "watch", "serve", "cache-stats"]
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(value):
+    # "500K", "2M", "1.5M" -> bytes per second; 0 disables the cap
+    value = value.strip().upper()
+    for suffix in ("/S", "B"):
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+    unit = value[-1:] if value[-1:] in RATE_UNITS else ""
+    try:
+        rate = int(float(value[:len(value) - len(unit)]) * RATE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate: {value}")
+    if rate < 0:
+        raise argparse.ArgumentTypeError(f"rate cannot be negative: {value}")
+    return rate
+
+
+def positive_int(value):
+    # Counts of jobs, segments and connections; 0 would deadlock or crash a worker pool
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+
+def non_negative_float(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: {value}")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"cannot be negative: {value}")
+    return number
+
+
+class ConsoleReporter:
+    # Drains the same event bus the GUI uses; logs are printed as they arrive
+    # and a combined progress line at most once per interval
+    def __init__(self, events, quiet=False, interval=2.0):
+        self.events = events
+        self.quiet = quiet
+        self.interval = interval
+        self.tracker = ProgressTracker()
+        self.last_report = 0
+
+    def drain(self, final=False):
+        messages, _ = self.tracker.apply(self.events.drain())
+        if self.quiet:
+            return
+        for message in messages:
+            print(message, flush=True)
+        now = time.monotonic()
+        if self.tracker.files and (final or now - self.last_report >= self.interval):
+            self.last_report = now
+            done, total = self.tracker.totals()
+            print(
+                f"  [{self.tracker.percent():5.1f}%] {format_size(done)} of {format_size(total)}, "
+                f"{format_size(self.tracker.speed())}/s, ETA {format_eta(self.tracker.eta())} "
+                f"({self.tracker.completed_files()} of {len(self.tracker.files)} files)",
+                flush=True
+            )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="lineageos_cli",
+        description="Download and organize Switchroot LineageOS builds without the GUI."
+    )
+    parser.add_argument("--version", action="version", version=APP_VERSION)
+    subparsers = parser.add_subparsers(dest="command")
+
+    download = subparsers.add_parser("download", help="download the latest build (default command)")
+    download.add_argument("--device", action="append",
+                          choices=sorted(list(DEVICES) + list(DEVICE_ALIASES)),
+                          help="nx_tab (tablet) or nx (TV); repeat to mirror several (default: nx_tab)")
+    download.add_argument("--builds", type=positive_int, default=1,
+                          help="number of most recent builds to fetch per device")
+    download.add_argument("--gapps", action="store_true", help="also download MindTheGapps")
+    download.add_argument("--out", action="append",
+                          help="folder that receives the LineageOS-{version}-{date}-{device} tree; repeat it "
+                               "to write the same download to several folders or SD cards (default: ~/Downloads)")
+    download.add_argument("--jobs", type=positive_int, default=4, help="files downloaded in parallel")
+    download.add_argument("--segments", type=positive_int, default=4, help="parallel ranges per large file")
+    download.add_argument("--retries", type=positive_int, default=3,
+                          help="failed attempts per file; stalled streams that resume do not count")
+    download.add_argument("--stall-speed", type=parse_rate, default=parse_rate("32K"),
+                          help="re-request a stream slower than this over 20 seconds, e.g. 64K (0 = never)")
+    download.add_argument("--time-budget", type=non_negative_float, default=0,
+                          help="minutes per file across all attempts before giving up (default: unlimited)")
+    download.add_argument("--max-connections", type=positive_int, default=8,
+                          help="open connections across all files and segments")
+    download.add_argument("--per-host", type=positive_int, default=4, help="open connections per host")
+    download.add_argument("--limit-rate", type=parse_rate, default=0,
+                          help="total bandwidth cap, e.g. 500K or 2M (bytes per second)")
+    download.add_argument("--delta", action="store_true",
+                          help="rebuild the lineage zip from the previous build, fetching only changed entries")
+    download.add_argument("--delta-from", metavar="ZIP",
+                          help="previous lineage zip to use with --delta (default: newest older build in --out)")
+    download.add_argument("--resume", action="store_true",
+                          help="continue the last interrupted run from the journal without fetching build metadata")
+    download.add_argument("--zip-check", choices=["structure", "crc"], default="crc",
+                          help="how deeply to check zips without a published checksum")
+    download.add_argument("--sd-card", action="store_true",
+                          help="--out is an SD card: preallocate files, write aligned blocks, "
+                               "fsync each file and write android.ini last")
+    download.add_argument("--cache-server", metavar="URL",
+                          help="fetch through a LAN cache server, e.g. http://workshop-pc:8080 "
+                               "(default: $LINEAGEOS_CACHE_SERVER)")
+    download.add_argument("--metrics-file", metavar="FILE",
+                          help="append per-phase timings and per-file summaries as JSON lines")
+    download.add_argument("--metrics-port", type=int, metavar="PORT",
+                          help="serve Prometheus metrics on http://0.0.0.0:PORT/metrics during the run")
+    download.add_argument("--log-file", default="lineageos_downloader.log")
+    download.add_argument("--quiet", action="store_true", help="only report the exit status")
+
+    verify = subparsers.add_parser("verify", help="check a LineageOS-* folder against its build manifest")
+    verify.add_argument("folder", help="a LineageOS-{version}-{date}-{device} folder, e.g. on an SD card")
+    verify.add_argument("--workers", type=positive_int, help="hashing processes (default: one per CPU core)")
+    verify.add_argument("--zip-check", choices=["structure", "crc"], default="crc",
+                        help="how deeply to check zips without a published checksum")
+    verify.add_argument("--log-file", default="lineageos_downloader.log")
+    verify.add_argument("--quiet", action="store_true", help="only report the exit status")
+
+    watch = subparsers.add_parser("watch", help="poll for new builds and prefetch them in the background")
+    watch.add_argument("--device", action="append",
+                       choices=sorted(list(DEVICES) + list(DEVICE_ALIASES)),
+                       help="nx_tab (tablet) or nx (TV); repeat for several (default: both)")
+    watch.add_argument("--no-gapps", action="store_true", help="do not prefetch MindTheGapps")
+    watch.add_argument("--out", default=os.path.expanduser("~/Downloads"),
+                       help="folder that receives the LineageOS-{version}-{date}-{device} trees")
+    watch.add_argument("--interval", type=float, default=60, help="minutes between checks")
+    watch.add_argument("--jitter", type=non_negative_float, default=0.2,
+                       help="random spread applied to the interval, as a fraction of it")
+    watch.add_argument("--limit-rate", type=parse_rate, default=parse_rate("4M"),
+                       help="bandwidth cap for prefetching, e.g. 500K or 2M (default: 4M, 0 = unlimited)")
+    watch.add_argument("--jobs", type=positive_int, default=2, help="files downloaded in parallel")
+    watch.add_argument("--once", action="store_true", help="check and prefetch once, then exit")
+    watch.add_argument("--cache-server", metavar="URL", help="fetch through a LAN cache server")
+    watch.add_argument("--log-file", default="lineageos_downloader.log")
+    watch.add_argument("--quiet", action="store_true", help="only report the exit status")
+
+    serve = subparsers.add_parser("serve", help="run a LAN cache server that other instances download through")
+    serve.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--root", default=os.path.join(os.path.expanduser("~"), ".lineageos_downloader", "server"),
+                       help="folder for the server's cache")
+    # Sizes use the same suffixes as rates
+    serve.add_argument("--quota", type=parse_rate, default=parse_rate("32G"),
+                       help="disk space for cached builds, e.g. 32G; least recently used builds are evicted")
+    serve.add_argument("--log-file", default="lineageos_downloader.log")
+
+    stats = subparsers.add_parser("cache-stats", help="print artifact and metadata cache statistics")
+    stats.add_argument("--log-file", default="lineageos_downloader.log")
+    return parser
+
+
+def run_download(args):
+    events = EventBus()
+    reporter = ConsoleReporter(events, quiet=args.quiet)
+    core = LineageOSCore(events=events)
+    core.retry_attempts = args.retries
+    core.stall_speed = args.stall_speed
+    core.file_time_budget = args.time_budget * 60
+    core.segment_count = args.segments
+    core.max_connections = args.max_connections
+    core.per_host_connections = args.per_host
+    core.bandwidth_limit = args.limit_rate
+    core.delta_updates = args.delta or bool(args.delta_from)
+    core.delta_source = args.delta_from
+    core.zip_check_level = args.zip_check
+    core.sd_staging = args.sd_card
+    if args.cache_server:
+        core.cache_server = args.cache_server
+    if args.metrics_file:
+        core.metrics.open(args.metrics_file)
+    if args.metrics_port:
+        serve_metrics(core.metrics, args.metrics_port)
+
+    devices = []
+    for device in args.device or ["nx_tab"]:
+        device = resolve_device(device)
+        if device not in devices:
+            devices.append(device)
+
+    try:
+        if args.resume:
+            plans = core.load_unfinished_plans(include_failed=True)
+            if not plans:
+                raise ValueError("no interrupted download found")
+        else:
+            plans = core.resolve_batch(devices, count=args.builds, gapps=args.gapps)
+        roots = args.out or [os.path.expanduser("~/Downloads")]
+        for plan in plans:
+            # Resumed plans keep the folder they were started in
+            core.create_folders_and_ini(plan, os.path.dirname(plan.target_dir) if plan.target_dir else roots[0])
+            # Every further --out gets its own tree, fed from the same download
+            for root in roots[1:]:
+                core.add_fanout_target(plan, root)
+    except Exception as e:
+        reporter.drain()
+        print(f"Failed to prepare download: {e}", file=sys.stderr)
+        return 2
+    reporter.drain()
+
+    # Run in a worker so Ctrl+C reaches us and can cancel in-flight files
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(ok=core.download_batch(plans, jobs=args.jobs)),
+                              daemon=True)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.2)
+            reporter.drain()
+    except KeyboardInterrupt:
+        print("Canceling download...", file=sys.stderr)
+        core.cancel()
+        worker.join()
+        reporter.drain()
+        return 130
+    reporter.drain(final=True)
+    return 0 if result.get('ok') else 1
+
+
+def run_verify(args):
+    events = EventBus()
+    reporter = ConsoleReporter(events, quiet=args.quiet)
+    core = LineageOSCore(events=events)
+    core.zip_check_level = args.zip_check
+    try:
+        plan = core.plan_for_folder(args.folder)
+        results = core.verify_tree(plan, workers=args.workers)
+    except Exception as e:
+        reporter.drain()
+        print(f"Failed to verify {args.folder}: {e}", file=sys.stderr)
+        return 2
+    reporter.drain()
+    return 0 if all(result['status'] in ("ok", "present") for result in results) else 1
+
+
+def run_watch(args):
+    events = EventBus()
+    reporter = ConsoleReporter(events, quiet=args.quiet, interval=30.0)
+    core = LineageOSCore(events=events)
+    core.jobs = args.jobs
+    core.bandwidth_limit = args.limit_rate
+    core.verify_workers = 1  # Hashing leftovers on every core would defeat the low priority
+    if args.cache_server:
+        core.cache_server = args.cache_server
+    lower_priority()
+    devices = []
+    for device in args.device or ["nx_tab", "nx"]:
+        device = resolve_device(device)
+        if device not in devices:
+            devices.append(device)
+    watcher = BuildWatcher(core, devices, args.out, gapps=not args.no_gapps,
+                           interval=args.interval * 60, jitter=args.jitter)
+    if args.once:
+        ok = watcher.poll_once()
+        reporter.drain(final=True)
+        return 0 if ok else 1
+
+    worker = threading.Thread(target=watcher.run, daemon=True)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.5)
+            reporter.drain()
+    except KeyboardInterrupt:
+        print("Stopping watcher...", file=sys.stderr)
+        watcher.stop()
+        worker.join()
+        reporter.drain()
+    return 0
+
+
+def run_serve(args):
+    server = CacheServer(args.root, args.quota, address=(args.host, args.port))
+    print(f"Serving on http://{args.host}:{args.port}; point other instances at it with "
+          f"--cache-server or LINEAGEOS_CACHE_SERVER (Ctrl+C stops)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print(server.cache.format_stats())
+    return 0
+
+
+def run_cache_stats(args):
+    core = LineageOSCore()
+    print(core.artifact_cache.format_stats())
+    print(core.metadata_cache.format_stats())
+    return 0
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # "lineageos_cli --device nx_tab ..." is shorthand for the download command
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help", "--version")):
+        argv.insert(0, "download")
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_file)
+    if args.command == "cache-stats":
+        return run_cache_stats(args)
+    if args.command == "verify":
+        return run_verify(args)
+    if args.command == "watch":
+        return run_watch(args)
+    if args.command == "serve":
+        return run_serve(args)
+    return run_download(args)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
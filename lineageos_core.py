@@ -0,0 +1,1578 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, urlencode, quote
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from artifact_cache import ArtifactCache
+from file_utils import format_size, write_json_atomic
+from metadata_cache import MetadataCache
+from mirrors import MirrorSelector
+from delta_update import DeltaUpdater
+from zip_validation import ZipValidator
+from verifier import hash_files
+from events import EventBus
+from chunk_reader import AdaptiveChunkReader, write_all
+from metrics import PipelineMetrics
+from download_journal import DownloadJournal, FINISHED_STATES
+from sd_staging import BlockWriter, WriteStats, copy_staged, preallocate, sync_file, sync_directory
+from fanout import FanOutWriter
+from retry_policy import RetryPolicy, StallDetector, LinkMeter
+from scheduler import (DownloadScheduler, ConnectionLimiter, TokenBucket, DownloadCanceled,
+                       abort_response, host_of)
+
+APP_VERSION = "v1.0.3"
+
+BUILDS_API = "https://download.lineageos.org/api/v2/devices/{device}/builds"
+GAPPS_API = "https://api.github.com/repos/MindTheGapps/{android_version}.0.0-{gapps_suffix}/releases/latest"
+
+# Switchroot codenames; the GUI still talks about "tablet" and "tv"
+DEVICES = {
+    "nx_tab": {"label": "Tablet", "gapps_suffix": "arm64"},
+    "nx": {"label": "TV", "gapps_suffix": "arm64-ATV"},
+}
+DEVICE_ALIASES = {"tablet": "nx_tab", "tv": "nx"}
+
+# Map LineageOS version to Android version
+ANDROID_VERSIONS = {
+    "20.0": "13",
+    "21.0": "14",
+    "22.0": "15",
+    "22.1": "15"
+}
+
+PERMANENT_LINKS = [
+    "https://wiki.lineageos.org/images/device_specific/nx/bootlogo_android.bmp",
+    "https://wiki.lineageos.org/images/device_specific/nx/icon_android_hue.bmp"
+]
+
+INSTALL_FILES = ["boot.img", "recovery.img", "nx-plat.dtimg"]
+ANDROID_FILES = ["bl31.bin", "bl33.bin", "boot.scr", "icon_android_hue.bmp", "bootlogo_android.bmp"]
+
+ANDROID_INI = """[LineageOS]
+l4t=1
+boot_prefixes=switchroot/android/
+id=SWANDR
+icon=switchroot/android/icon_android_hue.bmp
+logopath=switchroot/android/bootlogo_android.bmp
+r2p_action=self
+; alarms_disable=1 uncomment to disable notifications for better battery life
+; touch_skip_tuning=1 uncomment if your touchscreen is broken
+; usb3_enable=1 uncomment for faster USB at expense of WiFi/BT quality
+; ddr200_enable=1 uncomment for faster SD speed on models that support it (Samsung enabled by default)
+; emmc=1 uncomment to boot from the internal eMMC (not reccomended, and requires a signifigantly different set of installation instructions/partitioning process)
+"""
+
+
+def resolve_device(name):
+    device = DEVICE_ALIASES.get(name.lower(), name.lower())
+    if device not in DEVICES:
+        raise ValueError(f"Unknown device: {name} (expected one of {', '.join(DEVICES)})")
+    return device
+
+
+def target_folder_for(target_dir, filename):
+    # Determine the target folder based on file type
+    if filename in INSTALL_FILES:
+        return os.path.join(target_dir, "switchroot", "install")
+    elif filename in ANDROID_FILES:
+        return os.path.join(target_dir, "switchroot", "android")
+    elif filename.startswith("MindTheGapps"):
+        return target_dir  # GApps go to root folder
+    else:
+        return target_dir  # Default to root folder (e.g., LineageOS ZIP)
+
+
+def url_filename(url):
+    return os.path.basename(urlsplit(url).path)
+
+
+def configure_logging(filename='lineageos_downloader.log'):
+    logging.basicConfig(
+        filename=filename,
+        level=logging.DEBUG,
+        format='%(asctime)s:%(levelname)s:%(message)s'
+    )
+
+
+class HashFrontier:
+    # Follows the contiguous written prefix of a file. Bytes arriving at the
+    # frontier are hashed from memory; bytes written ahead of it (other
+    # segments) are read back from disk once the frontier reaches them.
+    def __init__(self, file_path, total_size):
+        self.file_path = file_path
+        self.total_size = total_size
+        self.position = 0
+        self.hasher = hashlib.sha256()
+        self.catching_up = False
+        self.lock = threading.Lock()
+        self.segments = []
+
+    def attach(self, segments):
+        with self.lock:
+            self.segments = segments
+
+    def record(self, segment, offset, data):
+        with self.lock:
+            segment['done'] += len(data)
+            if not self.catching_up and offset == self.position:
+                self.hasher.update(data)
+                self.position += len(data)
+            if self.catching_up or self.written_end() <= self.position:
+                return
+            self.catching_up = True
+        self.catch_up()
+
+    def written_end(self):
+        for segment in self.segments:
+            if segment['start'] <= self.position <= segment['end']:
+                return segment['start'] + segment['done']
+        return self.position
+
+    def catch_up(self):
+        with open(self.file_path, 'rb') as f:
+            while True:
+                with self.lock:
+                    end = self.written_end()
+                    if end <= self.position:
+                        self.catching_up = False
+                        return
+                    start = self.position
+                f.seek(start)
+                data = f.read(min(end - start, 1024 * 1024))
+                if not data:
+                    with self.lock:
+                        self.catching_up = False
+                    raise ValueError(f"Short read while hashing {self.file_path} at {start}")
+                with self.lock:
+                    self.hasher.update(data)
+                    self.position += len(data)
+
+    def hexdigest(self):
+        with self.lock:
+            self.catching_up = True
+        self.catch_up()
+        with self.lock:
+            if self.position != self.total_size:
+                raise ValueError(f"Hashed {self.position} of {self.total_size} bytes of {self.file_path}")
+            return self.hasher.hexdigest()
+
+
+class BuildPlan:
+    def __init__(self, device, build):
+        self.device = device
+        self.build = build
+        self.version = build['version']
+        self.date = build['date'].replace("-", "")
+        self.urls = []
+        self.checksums = {}  # url -> sha256 from the build API (None for GApps and bitmaps)
+        self.sizes = {}  # url -> size in bytes when the API reports it
+        self.gapps_url = None
+        self.gapps_filename = None
+        self.target_dir = None
+        self.fanout_dirs = []  # Further trees (e.g. other SD cards) that get a copy of every file
+
+        for file in build['files']:
+            if 'super_empty.img' in file['url']:
+                continue
+            self.urls.append(file['url'])
+            self.checksums[file['url']] = file.get('sha256')
+            if file.get('size'):
+                self.sizes[file['url']] = file['size']
+        self.urls.extend(PERMANENT_LINKS)
+
+    def label(self):
+        return f"{self.version}-{self.date}"
+
+    def folder_name(self):
+        return f"LineageOS-{self.version}-{self.date}-{DEVICES[self.device]['label']}"
+
+    def add_gapps(self, gapps_url, gapps_filename, size=None):
+        self.gapps_url = gapps_url
+        self.gapps_filename = gapps_filename
+        if gapps_url and gapps_url not in self.urls:
+            self.urls.append(gapps_url)
+            if size:
+                self.sizes[gapps_url] = size
+
+    def file_path(self, url):
+        filename = os.path.basename(url)
+        return os.path.join(target_folder_for(self.target_dir, filename), filename)
+
+    def file_paths(self):
+        for url in self.urls:
+            yield url, self.file_path(url)
+
+    def subset(self, urls):
+        plan = BuildPlan.__new__(BuildPlan)
+        plan.__dict__.update(self.__dict__)
+        plan.urls = list(urls)
+        return plan
+
+
+class LineageOSCore:
+    def __init__(self, events=None, state_dir=None):
+        # Workers only post here; the GUI or console drains it on its own tick
+        self.events = events or EventBus()
+        self.metrics = PipelineMetrics()
+        self.retry_attempts = 3
+        self.jobs = 4
+        self.max_connections = 8  # Open connections across all files and segments
+        self.per_host_connections = 4  # e.g. LineageOS mirror vs. GitHub
+        self.bandwidth_limit = 0  # Bytes per second shared by all transfers, 0 = unlimited
+        self.limiter = ConnectionLimiter(self.max_connections, self.per_host_connections)
+        self.bandwidth = TokenBucket(self.bandwidth_limit)
+        self.active_responses = set()
+        self.responses_lock = threading.Lock()
+        self.cancel_hooks = []
+        self.cancel_download = False
+        self.total_downloaded = 0
+        self.total_files = 0
+        self.failed_downloads = []
+        self.http_session = None  # Created by the session property on first network use
+        self.session_lock = threading.Lock()
+        self.connect_timing = threading.local()  # Seconds the current thread's request spent connecting
+        self.connect_timeout = 10
+        self.read_timeout = 60
+        # A stream below stall_speed for stall_window seconds is re-requested from where it stands
+        self.stall_speed = 32 * 1024
+        self.stall_window = 20.0
+        self.file_time_budget = 0  # Seconds per file across all attempts, 0 = unlimited
+        self.file_deadlines = {}  # .part path -> monotonic deadline of its time budget
+        self.retry_policy = RetryPolicy()
+        self.link_meter = LinkMeter(self.stall_window)
+        self.segment_count = 4  # Parallel ranges per large file
+        self.segment_threshold = 32 * 1024 * 1024  # Only split files larger than this
+        self.state_save_interval = 1.0  # Seconds between segment state checkpoints
+        self.min_chunk_size = 16 * 1024  # Read size bounds for the adaptive stream loop
+        self.max_chunk_size = 1024 * 1024
+        self.partial_hashers = {}  # .part path -> HashFrontier kept across retry attempts
+        self.state_dir = state_dir or os.path.join(os.path.expanduser("~"), ".lineageos_downloader")
+        self.verified_records = None  # Loaded lazily from verified.json
+        self.records_lock = threading.Lock()
+        self.artifact_cache = ArtifactCache(os.path.join(self.state_dir, "artifacts"),
+                                            max_bytes=8 * 1024 ** 3)
+        self.metadata_cache = MetadataCache(os.path.join(self.state_dir, "metadata"))
+        self.mirrors = MirrorSelector(os.path.join(self.state_dir, "mirrors.json"))
+        self.mirror_discovery_rounds = 3  # Redirects sampled per large file to find mirrors
+        self.discovered_urls = set()
+        self.delta_updates = False  # Rebuild the lineage zip from the previous build when possible
+        self.delta_source = None  # Previous zip to use; None searches sibling build folders
+        # "structure" compares headers only; "crc" also decompresses members across processes
+        self.zip_check_level = "crc"
+        self.zip_validator = ZipValidator(os.path.join(self.state_dir, "zip_checks.json"))
+        self.journal = DownloadJournal(os.path.join(self.state_dir, "journal.sqlite3"))
+        self.verify_workers = None  # Processes hashing existing files; None uses every core
+        # SD card staging: preallocated files, block-aligned writes, fsync per file and android.ini last
+        self.sd_staging = False
+        self.staging_block_size = 4 * 1024 * 1024  # A common SD erase block size
+        self.write_stats = WriteStats()
+        self.fanouts = {}  # .part path -> FanOutWriter copying that stream to the fan-out trees
+        self.fanout_queue_bytes = 64 * 1024 * 1024  # Per target; a card further behind catches up afterwards
+        # LAN cache server (lineageos_cli serve) that stands in for every upstream URL
+        self.cache_server = os.environ.get("LINEAGEOS_CACHE_SERVER") or None
+
+    @property
+    def session(self):
+        # requests pulls in urllib3, ssl and certifi; importing it on first use keeps
+        # that off the GUI's startup path and on whichever worker gets there first
+        if self.http_session is None:
+            with self.session_lock:
+                if self.http_session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    # The default pool of 10 connections is smaller than our connection budget allows
+                    adapter = HTTPAdapter(pool_maxsize=32)
+                    adapter.poolmanager.pool_classes_by_scheme = self.timed_pool_classes()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.hooks['response'].append(self.split_connect_time)
+                    self.http_session = session
+        return self.http_session
+
+    def timed_pool_classes(self):
+        # response.elapsed covers DNS, TCP and TLS setup as well as the wait for the
+        # first byte; timing urllib3's connect() lets the two be recorded apart
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+        core = self
+
+        def timed(pool_class):
+            class TimedConnection(pool_class.ConnectionCls):
+                def connect(self):
+                    started = time.monotonic()
+                    try:
+                        super().connect()
+                    finally:
+                        seconds = time.monotonic() - started
+                        core.connect_timing.seconds = seconds
+                        core.metrics.observe('connect', seconds, host=self.host)
+            return type(pool_class.__name__, (pool_class,), {'ConnectionCls': TimedConnection})
+        return {'http': timed(HTTPConnectionPool), 'https': timed(HTTPSConnectionPool)}
+
+    def split_connect_time(self, response, *args, **kwargs):
+        # Runs after each request of a redirect chain, so the final response carries its own share
+        response.connect_seconds = getattr(self.connect_timing, 'seconds', 0.0)
+        self.connect_timing.seconds = 0.0
+
+    def log_message(self, message):
+        logging.info(message)
+        self.events.post('log', message=message)
+
+    def report_start(self, file_path, total, done):
+        self.events.post('file_start', file=file_path, name=os.path.basename(file_path), total=total, done=done)
+        self.journal_call(self.journal.file_started, file_path, total, done)
+
+    def report_progress(self, file_path, amount):
+        self.events.post('bytes', file=file_path, amount=amount)
+        self.journal_call(self.journal.file_progress, file_path, amount)
+
+    def report_file(self, file_path, status, **summary):
+        filename = os.path.basename(file_path)
+        self.events.post('file_done', file=file_path, name=filename, status=status)
+        self.journal_call(self.journal.file_finished, file_path, status, summary.get('sha256'))
+        self.metrics.inc('files', status=status)
+        self.metrics.emit('file', file=filename, status=status, **summary)
+
+    def journal_call(self, method, *args):
+        # The journal only makes resuming faster; a broken database must not stop a download
+        try:
+            return method(*args)
+        except sqlite3.Error as e:
+            logging.warning(f"Download journal unavailable: {e}")
+            return None
+
+    def load_unfinished_plans(self, include_failed=False):
+        # Rebuilds the plans of an interrupted run from the journal, without any network calls
+        record = self.journal_call(self.journal.unfinished_run, include_failed)
+        if not record:
+            return None
+        run, plan_rows, file_rows = record
+        plans = []
+        for position, device, build, gapps_url, gapps_filename, gapps_size, target_dir in plan_rows:
+            plan = BuildPlan(device, json.loads(build))
+            plan.add_gapps(gapps_url, gapps_filename, gapps_size)
+            urls = set(row[1] for row in file_rows if row[2] == position)
+            plan = plan.subset([url for url in plan.urls if url in urls])
+            plan.target_dir = target_dir
+            plans.append(plan)
+        finished = sum(1 for row in file_rows if row[4] in FINISHED_STATES)
+        partial = sum(row[5] for row in file_rows if row[4] not in FINISHED_STATES)
+        started = time.strftime("%Y-%m-%d %H:%M", time.localtime(run[1]))
+        self.log_message(
+            f"Found interrupted download from {started}: {finished} of {len(file_rows)} files done, "
+            f"{format_size(partial)} partially downloaded"
+        )
+        return plans
+
+    def via_cache_server(self, url, sha256=None):
+        if not self.cache_server:
+            return url
+        query = {'url': url}
+        if sha256:
+            query['sha256'] = sha256
+        # The file name stays in the path so logs and metrics still show it
+        return f"{self.cache_server.rstrip('/')}/fetch/{quote(url_filename(url))}?{urlencode(query)}"
+
+    def count_bytes(self, url, amount):
+        if amount > 0:
+            self.metrics.inc('bytes_downloaded', amount)
+            self.metrics.inc('mirror_bytes', amount, host=host_of(url))
+
+    def fetch_builds(self, device, count=1):
+        url = BUILDS_API.format(device=device)
+        try:
+            self.log_message(f"Fetching builds from: {url}")
+            builds = self.metadata_cache.get_json(self.session, self.via_cache_server(url),
+                                                  timeout=(self.connect_timeout, self.read_timeout))
+            if not builds:
+                raise ValueError("No builds found in response")
+            return sorted(builds, key=lambda x: x['date'], reverse=True)[:count]
+        except Exception as e:
+            self.log_message(f"Error fetching builds for {device}: {str(e)}")
+            raise
+
+    def fetch_latest_build(self, device):
+        return self.fetch_builds(device, 1)[0]
+
+    def fetch_gapps_url(self, device, version):
+        gapps_suffix = DEVICES[device]['gapps_suffix']
+        android_version = ANDROID_VERSIONS.get(version, "15")  # Default to 15 for unknown versions
+        github_api = GAPPS_API.format(android_version=android_version, gapps_suffix=gapps_suffix)
+
+        try:
+            self.log_message(f"Fetching MindTheGapps from: {github_api}")
+            headers = {'Accept': 'application/vnd.github.v3+json'}
+            # Conditional requests answered with 304 do not count against GitHub's rate limit
+            gapps_json = self.metadata_cache.get_json(
+                self.session,
+                self.via_cache_server(github_api),
+                headers=headers,
+                timeout=(self.connect_timeout, self.read_timeout)
+            )
+            gapps_url = None
+            gapps_filename = None
+            gapps_size = None
+            for asset in gapps_json.get('assets', []):
+                name = asset['name']
+                if (f"MindTheGapps-{android_version}.0.0-{gapps_suffix}" in name and
+                    "arm64" in name and name.endswith(".zip")):
+                    gapps_url = asset['browser_download_url']
+                    gapps_filename = name
+                    gapps_size = asset.get('size')
+                    break
+            if not gapps_url:
+                self.log_message("Error: No matching MindTheGapps package found!")
+                return None, None, None
+            self.log_message(f"Found MindTheGapps: {gapps_filename}")
+            return gapps_url, gapps_filename, gapps_size
+        except Exception as e:
+            self.log_message(f"Error fetching MindTheGapps: {str(e)}")
+            return None, None, None
+
+    def resolve_plan(self, device, gapps=False):
+        return self.resolve_batch([device], count=1, gapps=gapps)[0]
+
+    def resolve_plan_async(self, device, gapps=False, request=None):
+        # Returns at once; posts 'build_found' as soon as the build is known, then
+        # 'plan_ready' with GApps attached, or 'resolve_failed'
+        threading.Thread(target=self.resolve_plan_events, args=(device, gapps, request), daemon=True).start()
+
+    def resolve_plan_events(self, device, gapps, request):
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # GApps only depend on the Android version, so the lookup starts alongside the
+                # build request using the version of the last build list seen
+                guess = self.guess_version(device) if gapps else None
+                gapps_future = executor.submit(self.fetch_gapps_url, device, guess) if gapps else None
+                plan = BuildPlan(device, self.fetch_latest_build(device))
+                self.events.post('build_found', request=request, device=device, label=plan.label())
+                if gapps:
+                    if ANDROID_VERSIONS.get(plan.version, "15") != ANDROID_VERSIONS.get(guess, "15"):
+                        self.log_message(f"Android version changed with {plan.label()}; looking up GApps again")
+                        gapps_future = executor.submit(self.fetch_gapps_url, device, plan.version)
+                    plan.add_gapps(*gapps_future.result())
+            self.events.post('plan_ready', request=request, plan=plan)
+        except Exception as e:
+            self.events.post('resolve_failed', request=request, message=str(e))
+
+    def guess_version(self, device):
+        entry = self.metadata_cache.load(self.via_cache_server(BUILDS_API.format(device=device)))
+        if entry and entry.get('body'):
+            return max(entry['body'], key=lambda build: build['date'])['version']
+        return max(ANDROID_VERSIONS, key=lambda version: [int(part) for part in version.split(".")])
+
+    def resolve_batch(self, devices, count=1, gapps=False):
+        # Build lists for every device are fetched at once, and each GApps lookup
+        # starts as soon as the build that needs it is known
+        plans = []
+        errors = []
+        gapps_futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(devices) * 2)) as executor:
+            build_futures = {executor.submit(self.fetch_builds, device, count): device
+                             for device in devices}
+            for future in as_completed(build_futures):
+                device = build_futures[future]
+                try:
+                    builds = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                for build in builds:
+                    plan = BuildPlan(device, build)
+                    plans.append(plan)
+                    key = (device, plan.version)
+                    if gapps and key not in gapps_futures:
+                        gapps_futures[key] = executor.submit(self.fetch_gapps_url, device, plan.version)
+            for plan in plans:
+                if gapps:
+                    plan.add_gapps(*gapps_futures[(plan.device, plan.version)].result())
+        if not plans:
+            raise errors[0] if errors else ValueError("No builds found")
+        # Device order as requested, newest build first within each device
+        plans.sort(key=lambda plan: (devices.index(plan.device), -int(plan.date)))
+        self.log_message(f"Successfully fetched build information ({len(plans)} build{'s' if len(plans) != 1 else ''})")
+        return plans
+
+    def create_folders_and_ini(self, plan, download_dir):
+        plan.target_dir = os.path.join(download_dir, plan.folder_name())
+        self.create_build_tree(plan.target_dir)
+        return plan.target_dir
+
+    def add_fanout_target(self, plan, download_dir):
+        target_dir = os.path.join(download_dir, plan.folder_name())
+        if target_dir == plan.target_dir or target_dir in plan.fanout_dirs:
+            return
+        self.create_build_tree(target_dir)
+        plan.fanout_dirs.append(target_dir)
+
+    def create_build_tree(self, target_dir):
+        os.makedirs(target_dir, exist_ok=True)
+        os.makedirs(os.path.join(target_dir, "switchroot", "install"), exist_ok=True)
+        os.makedirs(os.path.join(target_dir, "switchroot", "android"), exist_ok=True)
+        os.makedirs(os.path.join(target_dir, "bootloader", "ini"), exist_ok=True)
+        if self.sd_staging:
+            # Hekate only shows the entry once android.ini exists, so it goes on the card last
+            self.log_message(f"Created folders in: {target_dir} (android.ini is written after the files)")
+        else:
+            self.write_android_ini(target_dir)
+            self.log_message(f"Created folders and generated android.ini in: {target_dir}")
+
+    def write_android_ini(self, target_dir, sync=False):
+        ini_folder = os.path.join(target_dir, "bootloader", "ini")
+        ini_path = os.path.join(ini_folder, "android.ini")
+        with open(ini_path, "w") as f:
+            f.write(ANDROID_INI)
+            if sync:
+                f.flush()
+                self.sync_staged(ini_path, f)
+        if sync:
+            for folder in (ini_folder, os.path.dirname(ini_folder), target_dir):
+                sync_directory(folder)
+
+    def sync_staged(self, path, f=None):
+        started = time.monotonic()
+        if f is None:
+            sync_file(path)
+        else:
+            os.fsync(f.fileno())
+        self.write_stats.record_sync(path, time.monotonic() - started)
+
+    def finish_staging(self, plans):
+        self.log_message("Writing android.ini and flushing the card")
+        for plan in plans:
+            for target_dir in [plan.target_dir] + plan.fanout_dirs:
+                self.write_android_ini(target_dir, sync=True)
+                self.log_message(f"Generated android.ini in: {target_dir}")
+        for line in self.write_stats.report(format_size):
+            self.log_message(f"Write throughput on {line}")
+
+    def is_canceled(self):
+        return self.cancel_download
+
+    def cancel(self):
+        self.cancel_download = True
+        with self.responses_lock:
+            responses = list(self.active_responses)
+        for response in responses:
+            abort_response(response)
+        for hook in list(self.cancel_hooks):
+            hook()
+
+    def add_cancel_hook(self, hook):
+        self.cancel_hooks.append(hook)
+
+    def remove_cancel_hook(self, hook):
+        if hook in self.cancel_hooks:
+            self.cancel_hooks.remove(hook)
+
+    def wait_for_retry(self, delay):
+        # Short sleeps so Cancel is not held up by a long Retry-After
+        until = time.monotonic() + delay
+        while not self.cancel_download:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, 0.25))
+        return False
+
+    def stall_detector(self, temp_file_path):
+        floor = self.stall_speed
+        if floor and self.bandwidth.rate:
+            # Under a rate cap the streams share it, so only a stream far below its share has stalled
+            floor = min(floor, self.bandwidth.rate / self.max_connections / 4)
+        return StallDetector(floor, self.stall_window, self.file_deadlines.get(temp_file_path),
+                             self.link_meter, lambda: len(self.active_responses))
+
+    def partial_progress(self, temp_file_path):
+        # Bytes a resume would keep: the segment state's count, else the .part size
+        state_path = self.segment_state_path(temp_file_path)
+        try:
+            if os.path.exists(state_path):
+                with open(state_path, "r") as f:
+                    return sum(segment['done'] for segment in json.load(f)['segments'])
+            return os.path.getsize(temp_file_path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+
+    def stream_read_timeout(self):
+        # A read that waits longer than the stall window has stalled as well
+        return min(self.read_timeout, self.stall_window) if self.stall_speed else self.read_timeout
+
+    @contextmanager
+    def open_stream(self, url, headers=None, allow_status=()):
+        # Identity encoding keeps byte ranges and Content-Length about the file itself
+        # and lets the stream loop read the raw body straight into its buffer
+        headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
+        with self.limiter.slot(url, self.is_canceled):
+            response = self.session.get(
+                url,
+                headers=headers,
+                stream=True,
+                timeout=(self.connect_timeout, self.stream_read_timeout()),
+                allow_redirects=True
+            )
+            # Connection setup is its own 'connect' phase, so ttfb is the server's wait alone
+            ttfb = max(response.elapsed.total_seconds() - getattr(response, 'connect_seconds', 0.0), 0.0)
+            self.metrics.observe('ttfb', ttfb, url_filename(url),
+                                 host=host_of(response.url), status=response.status_code)
+            with self.responses_lock:
+                self.active_responses.add(response)
+            try:
+                if self.cancel_download:
+                    raise DownloadCanceled()
+                if response.status_code not in allow_status:
+                    response.raise_for_status()
+                yield response
+            finally:
+                with self.responses_lock:
+                    self.active_responses.discard(response)
+                response.close()
+
+    def download_plan(self, plan, jobs=None):
+        return self.download_batch([plan], jobs=jobs)
+
+    def deduplicate(self, plans):
+        # Same sha256 (or same URL when the API has no checksum) is fetched once
+        primaries = []
+        duplicates = []
+        seen = {}
+        for plan in plans:
+            for url in plan.urls:
+                key = plan.checksums.get(url) or url
+                if key in seen:
+                    duplicates.append((url, plan) + seen[key])
+                else:
+                    seen[key] = (url, plan)
+                    primaries.append((url, plan))
+        return primaries, duplicates
+
+    def link_duplicates(self, duplicates):
+        for url, plan, primary_url, primary_plan in duplicates:
+            filename = os.path.basename(url)
+            source = os.path.join(target_folder_for(primary_plan.target_dir, os.path.basename(primary_url)),
+                                  os.path.basename(primary_url))
+            dest_folder = target_folder_for(plan.target_dir, filename)
+            dest = os.path.join(dest_folder, filename)
+            if primary_url in self.failed_downloads or not os.path.exists(source):
+                self.failed_downloads.append(url)
+                continue
+            expected_checksum = plan.checksums.get(url)
+            if os.path.exists(dest) and (not expected_checksum or self.verify_checksum(dest, expected_checksum)):
+                self.replicate(url, plan, dest)
+                continue
+            try:
+                os.makedirs(dest_folder, exist_ok=True)
+                if os.path.exists(dest):
+                    os.remove(dest)
+                method = self.artifact_cache.clone_file(source, dest)
+                self.remember_checksum(dest, self.lookup_checksum(source))
+                self.report_file(dest, "shared")
+                self.log_message(f"Shared {filename} with {plan.folder_name()} ({method})")
+                self.replicate(url, plan, dest)
+            except OSError as e:
+                self.log_message(f"Could not place shared file {filename}: {str(e)}")
+                self.report_file(dest, "failed")
+                self.failed_downloads.append(url)
+
+    def download_batch(self, plans, jobs=None):
+        self.total_downloaded = 0
+        self.cancel_download = False
+        self.failed_downloads = []
+        self.limiter = ConnectionLimiter(self.max_connections, self.per_host_connections)
+        self.bandwidth = TokenBucket(self.bandwidth_limit)
+        self.link_meter = LinkMeter(self.stall_window)
+        self.write_stats.reset()
+        retries_before = self.retry_counts()
+        primaries, duplicates = self.deduplicate(plans)
+        self.total_files = len(primaries)
+        files = []
+        for url, plan in primaries + [(url, plan) for url, plan, _, _ in duplicates]:
+            filename = os.path.basename(url)
+            files.append((os.path.join(target_folder_for(plan.target_dir, filename), filename),
+                          filename, plan.sizes.get(url)))
+        self.events.post('plan', files=files)
+        self.journal_call(self.journal.begin_run, plans)
+        self.preverify_existing(primaries)
+        if duplicates:
+            self.log_message(f"Total files to download: {self.total_files} ({len(duplicates)} shared between builds)")
+        else:
+            self.log_message(f"Total files to download: {self.total_files}")
+
+        # One pool for every build, so the largest zips of all targets overlap
+        started_at = time.monotonic()
+        scheduler = DownloadScheduler(self, jobs=jobs or self.jobs, per_host=self.per_host_connections)
+        scheduler.run(primaries)
+        if not self.cancel_download:
+            self.link_duplicates(duplicates)
+        if not self.cancel_download:
+            if self.failed_downloads:
+                failed_files = ", ".join(os.path.basename(url) for url in self.failed_downloads)
+                self.log_message(f"Download finished with failures: {failed_files}")
+                self.log_message("Use Retry Failed or try another network/VPN if the same mirror keeps timing out.")
+            else:
+                if self.sd_staging:
+                    self.finish_staging(plans)
+                self.log_message("Download complete! Files are organized in the target folder.")
+            self.log_retry_summary(retries_before)
+            stats = self.artifact_cache.stats()
+            self.log_message(
+                f"Artifact cache: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{format_size(stats['bytes_saved'])} saved"
+            )
+        if self.cancel_download:
+            self.journal_call(self.journal.finish_run, "canceled")
+        else:
+            self.journal_call(self.journal.finish_run, "failed" if self.failed_downloads else "complete")
+        self.metrics.emit('run', seconds=round(time.monotonic() - started_at, 3),
+                          canceled=self.cancel_download, failed=len(self.failed_downloads),
+                          **self.metrics.snapshot())
+        return not self.cancel_download and not self.failed_downloads
+
+    def retry_counts(self):
+        counts = {kind: self.metrics.value('retries', reason=kind) for kind in self.retry_policy.kinds}
+        counts['stalls'] = self.metrics.value('stalls')
+        return counts
+
+    def log_retry_summary(self, before):
+        # Counters live as long as the process (e.g. the watcher), so report this batch's share
+        counts = {kind: count - before.get(kind, 0) for kind, count in self.retry_counts().items()}
+        stalls = counts.pop('stalls')
+        if any(counts.values()) or stalls:
+            detail = ", ".join(f"{kind} {count}" for kind, count in counts.items() if count)
+            self.log_message(f"Retries: {sum(counts.values())} ({detail or 'none'}); stalled streams: {stalls}")
+
+    def download_file(self, url, plan):
+        file_path = plan.file_path(url)
+        fanout = self.start_fanout(url, plan, file_path)
+        if self.file_time_budget:
+            self.file_deadlines[file_path + ".part"] = time.monotonic() + self.file_time_budget
+        try:
+            self.download_primary(url, plan)
+        finally:
+            self.file_deadlines.pop(file_path + ".part", None)
+            if fanout:
+                self.fanouts.pop(file_path + ".part", None)
+                fanout.close()
+        if fanout and not self.cancel_download and url not in self.failed_downloads and os.path.exists(file_path):
+            self.replicate(url, plan, file_path, fanout)
+
+    def fanout_paths(self, url, plan):
+        filename = os.path.basename(url)
+        expected_checksum = plan.checksums.get(url)
+        paths = []
+        for target_dir in plan.fanout_dirs:
+            path = os.path.join(target_folder_for(target_dir, filename), filename)
+            if expected_checksum and os.path.exists(path) and self.lookup_checksum(path) == expected_checksum:
+                continue
+            paths.append(path)
+        return paths
+
+    def start_fanout(self, url, plan, file_path):
+        paths = self.fanout_paths(url, plan)
+        if not paths:
+            return None
+        fanout = self.fanout_writer(paths, plan.sizes.get(url))
+        fanout.start()
+        self.fanouts[file_path + ".part"] = fanout
+        return fanout
+
+    def fanout_writer(self, paths, total_size=None):
+        if not self.sd_staging:
+            return FanOutWriter(paths, total_size, max_queued=self.fanout_queue_bytes)
+        # Every card gets the staged treatment and its own line in the write report
+        return FanOutWriter(paths, total_size, preallocate_files=True, max_queued=self.fanout_queue_bytes,
+                            block_size=self.staging_block_size, on_write=self.write_stats.record_write)
+
+    def replicate(self, url, plan, file_path, fanout=None):
+        # Completes every fan-out copy of a finished file and checks each one against the sha256 on its own
+        filename = os.path.basename(file_path)
+        if fanout is None:
+            paths = self.fanout_paths(url, plan)
+            if not paths:
+                return
+            fanout = self.fanout_writer(paths)
+        sha256 = plan.checksums.get(url) or self.lookup_checksum(file_path) or self.calculate_checksum(file_path)
+        sync = self.sync_staged if self.sd_staging else None
+        with ThreadPoolExecutor(max_workers=len(fanout.targets)) as executor:
+            futures = {executor.submit(fanout.finish_target, target, file_path, sha256, sync): target
+                       for target in fanout.targets}
+            for future in as_completed(futures):
+                target = futures[future]
+                folder = os.path.dirname(target.file_path)
+                try:
+                    copied = future.result()
+                except Exception as e:
+                    self.log_message(f"Could not write {filename} to {folder}: {str(e)}")
+                    self.metrics.inc('fanout_files', status="failed")
+                    if url not in self.failed_downloads:
+                        self.failed_downloads.append(url)
+                    continue
+                if self.sd_staging:
+                    sync_directory(folder)
+                self.remember_checksum(target.file_path, sha256)
+                self.metrics.inc('fanout_files', status="done")
+                self.metrics.inc('fanout_catchup_bytes', copied)
+                if copied:
+                    self.log_message(f"Verified {filename} in {folder} ({format_size(copied)} copied after the stream)")
+                else:
+                    self.log_message(f"Verified {filename} in {folder}")
+
+    def download_primary(self, url, plan):
+        filename = os.path.basename(url)
+
+        target_folder = target_folder_for(plan.target_dir, filename)
+        os.makedirs(target_folder, exist_ok=True)
+        file_path = os.path.join(target_folder, filename)
+        temp_file_path = file_path + ".part"
+
+        # Fetch the checksum from the API or None for GApps
+        expected_checksum = plan.checksums.get(url)
+        source_url = self.via_cache_server(url, expected_checksum)
+        failed_mirrors = set()
+        started_at = time.monotonic()
+        deadline = self.file_deadlines.get(temp_file_path)
+        attempt = 0
+        failures = 0
+        stalls = 0  # Stalled streams keep their progress, so they do not use up retry_attempts
+        idle_stalls = 0  # Stalls in a row that moved the file no further
+
+        while True:
+            attempt += 1
+            if self.cancel_download:
+                return
+
+            mirror_url = None
+            progress_before = self.partial_progress(temp_file_path)
+            try:
+                if os.path.exists(file_path):
+                    if expected_checksum:
+                        if self.verify_checksum(file_path, expected_checksum):
+                            self.log_message(f"File already exists and is complete: {filename}")
+                            self.report_file(file_path, "exists", sha256=expected_checksum)
+                            return
+                        else:
+                            self.log_message(f"Existing file is corrupted. Deleting: {filename}")
+                            os.remove(file_path)
+                    else:
+                        if filename.endswith(".zip") and not self.is_valid_zip(file_path):
+                            self.log_message(f"Existing ZIP file is corrupted. Deleting: {filename}")
+                            os.remove(file_path)
+                        else:
+                            self.log_message(f"File already exists: {filename}")
+                            self.report_file(file_path, "exists")
+                            return
+
+                probe = None
+                if attempt == 1:
+                    # Files without an API checksum are matched by ETag, which needs a HEAD
+                    if not expected_checksum:
+                        probe = self.probe_download(source_url)
+                    if self.link_from_cache(url, expected_checksum, file_path, probe):
+                        if self.sd_staging:
+                            self.sync_staged(file_path)
+                        self.report_file(file_path, "cached")
+                        self.total_downloaded += 1
+                        return
+
+                self.log_message(f"Downloading {filename} (Attempt {attempt})")
+                if probe is None:
+                    probe = self.probe_download(source_url)
+                if probe is not None and attempt == 1:
+                    self.log_download_source(source_url, probe, 0)
+                mirror_url = self.choose_mirror(source_url, probe, failed_mirrors)
+
+                actual_checksum = None
+                if attempt == 1 and self.can_delta(filename, expected_checksum, probe, temp_file_path):
+                    actual_checksum = self.try_delta_update(
+                        mirror_url, int(probe.headers['Content-Length']), plan,
+                        filename, temp_file_path, expected_checksum)
+                if actual_checksum is None:
+                    if self.can_segment(probe):
+                        actual_checksum = self.download_segmented(
+                            mirror_url, int(probe.headers['Content-Length']),
+                            file_path, temp_file_path)
+                    else:
+                        actual_checksum = self.download_single(
+                            mirror_url, file_path, temp_file_path,
+                            log_source=(probe is None and attempt == 1))
+                if self.cancel_download:
+                    return
+
+                if expected_checksum:
+                    if actual_checksum != expected_checksum:
+                        self.discard_partial(temp_file_path)
+                        raise ValueError(f"Checksum mismatch for {filename}")
+                elif filename.endswith(".zip"):
+                    if not self.is_valid_zip(temp_file_path):
+                        self.discard_partial(temp_file_path)
+                        raise ValueError(f"Invalid ZIP file: {filename}")
+
+                if self.sd_staging:
+                    self.sync_staged(temp_file_path)
+                os.rename(temp_file_path, file_path)
+                if self.sd_staging:
+                    sync_directory(target_folder)
+                self.zip_validator.rename(temp_file_path, file_path)
+                self.remove_segment_state(temp_file_path)
+                self.partial_hashers.pop(temp_file_path, None)
+                self.remember_checksum(file_path, actual_checksum)
+                self.store_in_cache(url, file_path, actual_checksum, probe)
+                seconds = time.monotonic() - started_at
+                size = os.path.getsize(file_path)
+                self.report_file(file_path, "done", sha256=actual_checksum, bytes=size, seconds=round(seconds, 3),
+                                 throughput=round(size / max(seconds, 0.001)),
+                                 mirror=host_of(mirror_url), attempts=attempt, stalls=stalls)
+                self.log_message(f"Finished download: {filename}")
+                self.total_downloaded += 1
+                return
+
+            except DownloadCanceled:
+                return
+            except Exception as e:
+                if self.cancel_download:
+                    return
+                kind = self.retry_policy.classify(e)
+                self.log_message(f"Attempt {attempt} failed: {str(e)}")
+                self.metrics.inc('errors', kind=type(e).__name__)
+                if kind == "stall":
+                    stalls += 1
+                    self.metrics.inc('stalls')
+                    if self.partial_progress(temp_file_path) > progress_before:
+                        idle_stalls = 0
+                    else:
+                        idle_stalls += 1
+                else:
+                    failures += 1
+                failover = bool(mirror_url and mirror_url != source_url)
+                if failover:
+                    # Retry elsewhere; a 404 only means this mirror has not synced the file yet
+                    failed_mirrors.add(mirror_url)
+                    if kind != "missing":
+                        self.mirrors.record_failure(mirror_url)
+                    self.log_message(f"Failing over from {urlsplit(mirror_url).netloc}")
+
+                delay = self.retry_policy.delay_for(kind, e, failures)
+                if kind == "budget" or (deadline and time.monotonic() + delay > deadline):
+                    reason = "time budget used up"
+                elif kind == "missing" and not failover:
+                    reason = "not found on the server"
+                elif failures >= self.retry_attempts:
+                    reason = f"{failures} failed attempts"
+                elif idle_stalls >= self.retry_policy.max_stalls:
+                    reason = f"stalled {idle_stalls} times without progress"
+                else:
+                    reason = None
+                if reason:
+                    self.failed_downloads.append(url)
+                    self.report_file(file_path, "failed", attempts=attempt, stalls=stalls, error=str(e))
+                    self.log_message(f"Permanent failure for {filename}: {reason}")
+                    return
+                self.metrics.inc('retries', reason=kind)
+                if delay >= 1:
+                    self.log_message(f"Retrying {filename} in {delay:.0f}s")
+                if not self.wait_for_retry(delay):
+                    return
+
+    def link_from_cache(self, url, expected_checksum, file_path, probe):
+        filename = os.path.basename(file_path)
+        sha256 = expected_checksum
+        if not sha256 and probe is not None:
+            sha256 = self.artifact_cache.lookup_alias(
+                url,
+                etag=probe.headers.get('ETag'),
+                last_modified=probe.headers.get('Last-Modified'),
+                size=int(probe.headers.get('Content-Length', 0))
+            )
+        try:
+            copy = self.staged_copy if self.sd_staging else None
+            method = self.artifact_cache.link_into(sha256, file_path, copy) if sha256 else None
+        except OSError as e:
+            self.log_message(f"Artifact cache unavailable for {filename}: {str(e)}")
+            return False
+        if method is None:
+            self.artifact_cache.record_miss()
+            return False
+        self.remember_checksum(file_path, sha256)
+        self.log_message(f"Using cached {filename} ({method})")
+        return True
+
+    def staged_copy(self, source, dest):
+        # The card is another volume, so a cache hit is a copy; it gets the same writes as a download
+        copy_staged(source, dest, self.staging_block_size,
+                    lambda offset, data, seconds: self.write_stats.record_write(dest, len(data), seconds))
+        return "staged copy"
+
+    def store_in_cache(self, url, file_path, sha256, probe):
+        etag = probe.headers.get('ETag') if probe is not None else None
+        last_modified = probe.headers.get('Last-Modified') if probe is not None else None
+        try:
+            self.artifact_cache.add(sha256, file_path, url=url, etag=etag, last_modified=last_modified)
+        except OSError as e:
+            logging.warning(f"Could not add {file_path} to artifact cache: {e}")
+
+    def choose_mirror(self, url, probe, exclude):
+        if self.cache_server:
+            return url  # The cache server picks its own upstream
+        if probe is not None:
+            self.mirrors.learn(url, probe.url)
+            size = int(probe.headers.get('Content-Length', 0))
+            if size >= self.segment_threshold and url not in self.discovered_urls:
+                self.discovered_urls.add(url)
+                self.discover_mirrors(url)
+        ranked = self.mirrors.rank(url, exclude)
+        mirror_url = ranked[0]
+        if mirror_url == url and probe is not None and probe.url not in exclude:
+            mirror_url = probe.url
+        if mirror_url != url:
+            stats = self.mirrors.find(mirror_url)
+            speed = f" ({format_size(stats['throughput'])}/s)" if stats and stats['throughput'] else ""
+            self.log_message(f"Using mirror {urlsplit(mirror_url).netloc}{speed}")
+        return mirror_url
+
+    def discover_mirrors(self, url):
+        # The redirector spreads requests across mirrors, so a few more HEADs reveal alternatives
+        for _ in range(self.mirror_discovery_rounds - 1):
+            probe = self.probe_download(url)
+            if probe is not None:
+                self.mirrors.learn(url, probe.url)
+        unmeasured = self.mirrors.unmeasured(url)
+        if unmeasured:
+            with ThreadPoolExecutor(max_workers=len(unmeasured)) as executor:
+                list(executor.map(self.probe_mirror, unmeasured))
+
+    def probe_mirror(self, mirror_url):
+        start = time.monotonic()
+        try:
+            with self.open_stream(mirror_url, {"Range": f"bytes=0-{self.mirrors.probe_bytes - 1}"}) as response:
+                ttfb = response.elapsed.total_seconds()
+                received = 0
+                for chunk in response.iter_content(chunk_size=65536):
+                    received += len(chunk)
+                    if received >= self.mirrors.probe_bytes:
+                        break
+            duration = max(time.monotonic() - start - ttfb, 0.001)
+            self.mirrors.record_success(mirror_url, ttfb, received / duration)
+            logging.debug(f"Mirror probe {mirror_url}: ttfb={ttfb:.3f}s, {format_size(received / duration)}/s")
+        except DownloadCanceled:
+            raise
+        except Exception as e:
+            self.mirrors.record_failure(mirror_url)
+            logging.debug(f"Mirror probe failed for {mirror_url}: {e}")
+
+    def can_delta(self, filename, expected_checksum, probe, temp_file_path):
+        if not self.delta_updates or not expected_checksum or probe is None:
+            return False
+        if not (filename.startswith("lineage-") and filename.endswith(".zip")):
+            return False
+        # An interrupted download resumes more cheaply than a rebuild
+        if os.path.exists(temp_file_path):
+            return False
+        return probe.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+    def find_previous_zip(self, plan, filename):
+        if self.delta_source:
+            return self.delta_source if os.path.isfile(self.delta_source) else None
+        parent = os.path.dirname(plan.target_dir)
+        suffix = f"-{DEVICES[plan.device]['label']}"
+        candidates = []
+        for folder in os.listdir(parent):
+            parts = folder.split('-')
+            if (not folder.startswith("LineageOS-") or not folder.endswith(suffix)
+                    or len(parts) != 4 or not parts[2].isdigit() or parts[2] >= plan.date):
+                continue
+            folder_path = os.path.join(parent, folder)
+            for name in os.listdir(folder_path):
+                if name.startswith("lineage-") and name.endswith(".zip") and name != filename:
+                    candidates.append((parts[2], os.path.join(folder_path, name)))
+        return max(candidates)[1] if candidates else None
+
+    def try_delta_update(self, url, total_size, plan, filename, temp_file_path, expected_checksum):
+        previous_zip = self.find_previous_zip(plan, filename)
+        if not previous_zip:
+            return None
+        delta_path = temp_file_path + ".delta"
+        self.log_message(f"Building {filename} from {os.path.basename(previous_zip)}")
+        file_path = os.path.join(os.path.dirname(temp_file_path), filename)
+        self.report_start(file_path, total_size, 0)
+        try:
+            with self.metrics.span('delta', filename) as span:
+                result = DeltaUpdater(self).build(url, total_size, previous_zip, delta_path, file_path)
+                if result is not None:
+                    span['reused'], span['bytes'] = result[1], result[2]
+            if result is None:
+                return None
+            actual_checksum, reused, fetched = result
+            self.count_bytes(url, fetched)
+            if actual_checksum != expected_checksum:
+                self.log_message(f"Delta rebuild of {filename} did not match the published checksum")
+                return None
+            os.replace(delta_path, temp_file_path)
+            self.log_message(
+                f"Delta update: reused {format_size(reused)}, downloaded {format_size(fetched)} "
+                f"({reused * 100 // total_size}% saved)"
+            )
+            return actual_checksum
+        except DownloadCanceled:
+            raise
+        except Exception as e:
+            self.log_message(f"Delta update failed, downloading the full zip: {str(e)}")
+            return None
+        finally:
+            if os.path.exists(delta_path):
+                os.remove(delta_path)
+
+    def probe_download(self, url):
+        try:
+            with self.limiter.slot(url, self.is_canceled):
+                with self.metrics.span('probe', url_filename(url)) as span:
+                    response = self.session.head(
+                        url,
+                        timeout=(self.connect_timeout, self.read_timeout),
+                        allow_redirects=True
+                    )
+                    span['status'] = response.status_code
+            response.raise_for_status()
+            return response
+        except DownloadCanceled:
+            raise
+        except Exception as e:
+            logging.debug(f"HEAD request failed for {url}: {e}")
+            return None
+
+    def can_segment(self, probe):
+        # Staged files always take the range path, which preallocates and tracks progress separately
+        if probe is None or (self.segment_count < 2 and not self.sd_staging):
+            return False
+        if self.cache_server:
+            # Its uplink is the bottleneck; one stream per file lets every client share its fetch
+            return False
+        if probe.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return False
+        size = int(probe.headers.get('Content-Length', 0))
+        return size >= self.segment_threshold or (self.sd_staging and size > 0)
+
+    def download_single(self, url, file_path, temp_file_path, log_source=False):
+        filename = os.path.basename(file_path)
+        downloaded_size = 0
+        # A segmented .part is preallocated, so its size says nothing about progress
+        if self.remove_segment_state(temp_file_path):
+            self.log_message(f"Server no longer accepts ranges for {filename}; restarting from the beginning")
+            self.partial_hashers.pop(temp_file_path, None)
+        elif os.path.exists(temp_file_path) and self.sd_staging:
+            self.log_message(f"Restarting {filename}; staged files resume only from servers that accept ranges")
+            self.discard_partial(temp_file_path)
+        elif os.path.exists(temp_file_path):
+            downloaded_size = os.path.getsize(temp_file_path)
+            self.log_message(f"Resuming partial download: {filename} from {format_size(downloaded_size)}")
+
+        headers = {"Range": f"bytes={downloaded_size}-"} if downloaded_size else {}
+        started_at = time.monotonic()
+        with self.metrics.span('transfer', filename, mode="single") as span:
+            with self.open_stream(url, headers, allow_status=(416,) if downloaded_size else ()) as response:
+                ttfb = response.elapsed.total_seconds()
+                if response.status_code == 416:
+                    # Nothing past our offset; if the server's size is ours, the .part is the whole file
+                    if response.headers.get('Content-Range', '') != f"bytes */{downloaded_size}":
+                        self.discard_partial(temp_file_path)
+                        response.raise_for_status()
+                    self.log_message(f"{filename} was already complete on disk")
+                    self.metrics.inc('range_done')
+                    span['bytes'] = 0
+                    self.partial_hashers.pop(temp_file_path, None)
+                    return self.calculate_checksum(temp_file_path)
+                if log_source:
+                    self.log_download_source(url, response, downloaded_size)
+
+                if downloaded_size and response.status_code == 200:
+                    # The full body is already on its way, so rewrite from zero with it
+                    self.log_message(f"Server did not resume {filename}; restarting from the beginning")
+                    downloaded_size = 0
+                    self.partial_hashers.pop(temp_file_path, None)
+
+                total_size = int(response.headers.get('Content-Length', 0)) + downloaded_size
+                resumed_from = downloaded_size
+                if resumed_from:
+                    self.metrics.inc('resumes')
+                segment = {'start': 0, 'end': sys.maxsize, 'done': downloaded_size}
+                frontier = self.get_hash_frontier(temp_file_path, None, [segment])
+                fanout = self.fanouts.get(temp_file_path)
+                detector = self.stall_detector(temp_file_path)
+                self.report_start(file_path, total_size, downloaded_size)
+                try:
+                    with open(temp_file_path, 'ab' if downloaded_size else 'wb', buffering=0) as f:
+                        writer = None
+                        if self.sd_staging:
+                            preallocate(f, total_size)
+                            writer = self.block_writer(f, temp_file_path, 0,
+                                                       lambda offset, data: frontier.record(segment, offset, data))
+                        for chunk in self.chunk_reader(response):
+                            if self.cancel_download:
+                                return None
+                            if writer:
+                                writer.write(chunk)
+                            else:
+                                write_all(f, chunk)
+                                frontier.record(segment, downloaded_size, chunk)
+                            if fanout:
+                                fanout.write(downloaded_size, chunk)
+                            downloaded_size += len(chunk)
+                            self.report_progress(file_path, len(chunk))
+                            self.bandwidth.consume(len(chunk), self.is_canceled)
+                            detector.record(len(chunk))
+                        if writer:
+                            writer.flush()
+                            f.truncate(downloaded_size)  # Content-Length may have promised more
+                finally:
+                    span['bytes'] = downloaded_size - resumed_from
+                    self.count_bytes(url, span['bytes'])
+        frontier.total_size = downloaded_size
+        self.mirrors.record_success(url, ttfb, (downloaded_size - resumed_from) /
+                                    max(time.monotonic() - started_at, 0.001))
+        with self.metrics.span('hash', filename, source="stream"):
+            return frontier.hexdigest()
+
+    def chunk_reader(self, response):
+        max_size = self.max_chunk_size
+        if self.bandwidth.rate:
+            # Keep single reads well inside the token bucket so the cap stays smooth
+            max_size = max(min(max_size, self.bandwidth.rate // 4), self.min_chunk_size)
+        return AdaptiveChunkReader(response, self.min_chunk_size, max_size)
+
+    def block_writer(self, f, temp_file_path, offset, on_block):
+        def on_write(position, data, seconds):
+            self.write_stats.record_write(temp_file_path, len(data), seconds)
+            on_block(position, data)
+        return BlockWriter(f, offset, self.staging_block_size, on_write)
+
+    def get_hash_frontier(self, temp_file_path, total_size, segments):
+        frontier = self.partial_hashers.get(temp_file_path)
+        done = sum(segment['done'] for segment in segments)
+        # Reuse the in-memory hash only if it still describes the bytes on disk
+        if frontier is None or frontier.total_size != total_size or frontier.position > done:
+            frontier = HashFrontier(temp_file_path, total_size)
+            self.partial_hashers[temp_file_path] = frontier
+        frontier.attach(segments)
+        return frontier
+
+    def discard_partial(self, temp_file_path):
+        self.partial_hashers.pop(temp_file_path, None)
+        self.remove_segment_state(temp_file_path)
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+    def segment_state_path(self, temp_file_path):
+        return temp_file_path + ".state"
+
+    def load_segment_state(self, temp_file_path, url, total_size):
+        state_path = self.segment_state_path(temp_file_path)
+        if os.path.exists(state_path) and os.path.exists(temp_file_path):
+            try:
+                with open(state_path, "r") as f:
+                    state = json.load(f)
+                if state.get('size') == total_size and os.path.getsize(temp_file_path) == total_size:
+                    return state
+                self.log_message(f"Segment state for {os.path.basename(url)} does not match the server; starting over")
+            except (OSError, ValueError) as e:
+                self.log_message(f"Ignoring unreadable segment state: {str(e)}")
+
+        # Carry over a single-stream .part as already-finished leading bytes
+        # (staged .part files are preallocated, so their size is not progress)
+        existing = 0
+        if os.path.exists(temp_file_path) and not os.path.exists(state_path) and not self.sd_staging:
+            existing = min(os.path.getsize(temp_file_path), total_size)
+
+        count = max(self.segment_count, 1) if total_size >= self.segment_threshold else 1
+        segment_size = -(-total_size // count)
+        if self.sd_staging:
+            # Segment boundaries on block boundaries keep every write aligned
+            block = self.staging_block_size
+            segment_size = -(-segment_size // block) * block
+        segments = []
+        for start in range(0, total_size, segment_size):
+            end = min(start + segment_size, total_size) - 1
+            done = max(0, min(existing - start, end - start + 1))
+            segments.append({'start': start, 'end': end, 'done': done})
+
+        with open(temp_file_path, 'r+b' if existing else 'wb') as f:
+            if self.sd_staging:
+                preallocate(f, total_size)
+            else:
+                f.truncate(total_size)
+        self.partial_hashers.pop(temp_file_path, None)
+        state = {'url': url, 'size': total_size, 'segments': segments}
+        self.save_segment_state(temp_file_path, state)
+        return state
+
+    def save_segment_state(self, temp_file_path, state):
+        write_json_atomic(self.segment_state_path(temp_file_path), state)
+
+    def remove_segment_state(self, temp_file_path):
+        state_path = self.segment_state_path(temp_file_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+            return True
+        return False
+
+    def download_segmented(self, url, total_size, file_path, temp_file_path):
+        filename = os.path.basename(file_path)
+        state = self.load_segment_state(temp_file_path, url, total_size)
+        segments = state['segments']
+        done_before = sum(segment['done'] for segment in segments)
+        if done_before:
+            self.log_message(f"Resuming segmented download: {filename} from {format_size(done_before)}")
+            self.metrics.inc('resumes')
+        pending = [segment for segment in segments if segment['start'] + segment['done'] <= segment['end']]
+        self.log_message(f"Downloading {filename} in {len(pending)} segments")
+        self.report_start(file_path, total_size, done_before)
+
+        frontier = self.get_hash_frontier(temp_file_path, total_size, segments)
+        started_at = time.monotonic()
+        lock = frontier.lock
+        failed = threading.Event()
+        progress = {'saved_at': time.time()}
+
+        def on_chunk(segment, offset, chunk):
+            frontier.record(segment, offset, chunk)
+            with lock:
+                now = time.time()
+                if now - progress['saved_at'] >= self.state_save_interval:
+                    self.save_segment_state(temp_file_path, state)
+                    progress['saved_at'] = now
+            self.report_progress(file_path, len(chunk))
+
+        with self.metrics.span('transfer', filename, mode="segmented", segments=len(pending)) as span:
+            try:
+                with ThreadPoolExecutor(max_workers=len(pending) or 1) as executor:
+                    futures = [executor.submit(self.download_segment, url, temp_file_path, segment, on_chunk, failed)
+                               for segment in pending]
+                    errors = []
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                        except Exception as e:
+                            failed.set()
+                            errors.append(e)
+            finally:
+                with lock:
+                    self.save_segment_state(temp_file_path, state)
+                    span['bytes'] = sum(segment['done'] for segment in segments) - done_before
+                self.count_bytes(url, span['bytes'])
+        if errors:
+            raise errors[0]
+        if self.cancel_download:
+            return None
+        self.mirrors.record_success(url, None, (total_size - done_before) /
+                                    max(time.monotonic() - started_at, 0.001))
+        with self.metrics.span('hash', filename, source="stream"):
+            return frontier.hexdigest()
+
+    def download_segment(self, url, temp_file_path, segment, on_chunk, failed):
+        offset = segment['start'] + segment['done']
+        end = segment['end']
+        if offset > end:
+            return
+        fanout = self.fanouts.get(temp_file_path)
+        with self.open_stream(url, {"Range": f"bytes={offset}-{end}"}) as response:
+            if response.status_code != 206:
+                raise ValueError(f"Server ignored range request for bytes {offset}-{end}")
+            # Started once connected, so time queued for a connection slot is not counted as a stall
+            detector = self.stall_detector(temp_file_path)
+            # Unbuffered so the hash frontier can read back what was written
+            with open(temp_file_path, 'r+b', buffering=0) as f:
+                f.seek(offset)
+                writer = None
+                if self.sd_staging:
+                    writer = self.block_writer(f, temp_file_path, offset,
+                                               lambda position, data: on_chunk(segment, position, data))
+                try:
+                    for chunk in self.chunk_reader(response):
+                        if self.cancel_download or failed.is_set():
+                            return
+                        remaining = end - offset + 1
+                        if len(chunk) > remaining:
+                            chunk = chunk[:remaining]
+                        if writer:
+                            writer.write(chunk)
+                        else:
+                            write_all(f, chunk)
+                            on_chunk(segment, offset, chunk)
+                        if fanout:
+                            fanout.write(offset, chunk)
+                        offset += len(chunk)
+                        if offset > end:
+                            break
+                        self.bandwidth.consume(len(chunk), self.is_canceled)
+                        detector.record(len(chunk))
+                finally:
+                    if writer:
+                        # Whatever arrived is written and recorded, so a resume starts after it
+                        writer.flush()
+        if offset <= end:
+            raise ValueError(f"Segment {segment['start']}-{end} ended early at {offset}")
+
+    def log_download_source(self, original_url, response, downloaded_size):
+        final_url = response.url
+        total_size = int(response.headers.get('Content-Length', 0)) + downloaded_size
+        accept_ranges = response.headers.get('Accept-Ranges', 'not reported')
+        if final_url != original_url:
+            self.log_message(f"Mirror: {final_url}")
+        self.log_message(
+            f"Download info: size={format_size(total_size)}, resume={accept_ranges}, timeout={self.stream_read_timeout():g}s"
+        )
+
+    def calculate_checksum(self, file_path):
+        sha256_hash = hashlib.sha256()
+        with self.metrics.span('hash', os.path.basename(file_path), source="file"):
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(8192), b""):
+                    sha256_hash.update(chunk)
+        return sha256_hash.hexdigest()
+
+    def verify_checksum(self, file_path, expected_checksum):
+        actual_checksum = self.lookup_checksum(file_path)
+        if actual_checksum is None:
+            actual_checksum = self.calculate_checksum(file_path)
+            self.remember_checksum(file_path, actual_checksum)
+        return actual_checksum == expected_checksum
+
+    def verified_records_path(self):
+        return os.path.join(self.state_dir, "verified.json")
+
+    def load_verified_records(self):
+        if self.verified_records is None:
+            try:
+                with open(self.verified_records_path(), "r") as f:
+                    self.verified_records = json.load(f)
+            except (OSError, ValueError):
+                self.verified_records = {}
+        return self.verified_records
+
+    def lookup_checksum(self, file_path):
+        # A (size, mtime) match means the file is unchanged since it was hashed
+        with self.records_lock:
+            record = self.load_verified_records().get(os.path.abspath(file_path))
+        if not record:
+            return None
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['sha256']
+        return None
+
+    def remember_checksum(self, file_path, sha256):
+        if not sha256:
+            return
+        try:
+            stat = os.stat(file_path)
+            with self.records_lock:
+                records = self.load_verified_records()
+                records[os.path.abspath(file_path)] = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'sha256': sha256
+                }
+                write_json_atomic(self.verified_records_path(), records)
+        except OSError as e:
+            logging.warning(f"Could not store checksum record for {file_path}: {e}")
+
+    def preverify_existing(self, items):
+        # Files left from an earlier run are hashed across processes up front, so the
+        # download workers find a verified record instead of hashing one at a time
+        expected = {}
+        for url, plan in items:
+            path = plan.file_path(url)
+            if plan.checksums.get(url) and os.path.exists(path) and self.lookup_checksum(path) is None:
+                expected[path] = plan.checksums[url]
+        if len(expected) < 2:
+            return
+        self.log_message(f"Checking {len(expected)} existing files in parallel")
+        for result in hash_files(expected, self.verify_workers):
+            if result['sha256']:
+                self.remember_checksum(result['path'], result['sha256'])
+
+    def plan_for_folder(self, folder):
+        # Works out the build from a LineageOS-{version}-{date}-{Label} folder name
+        parts = os.path.basename(os.path.normpath(folder)).split("-")
+        labels = {info['label']: device for device, info in DEVICES.items()}
+        if len(parts) != 4 or parts[0] != "LineageOS" or parts[3] not in labels:
+            raise ValueError(f"{folder} is not a LineageOS-<version>-<date>-<Tablet|TV> folder")
+        device = labels[parts[3]]
+        for build in self.fetch_builds(device, count=sys.maxsize):
+            plan = BuildPlan(device, build)
+            if plan.version == parts[1] and plan.date == parts[2]:
+                plan.target_dir = os.path.abspath(folder)
+                return plan
+        raise ValueError(f"LineageOS {parts[1]} from {parts[2]} is no longer listed for {device}")
+
+    def verify_tree(self, plan, workers=None):
+        started_at = time.monotonic()
+        results = []
+        expected = {}
+        zips = []
+        for url, path in plan.file_paths():
+            if not os.path.exists(path):
+                results.append({'file': path, 'status': "missing", 'size': 0})
+            elif plan.checksums.get(url):
+                expected[path] = plan.checksums[url]
+            elif path.endswith(".zip"):
+                zips.append(path)
+            else:
+                results.append({'file': path, 'status': "present", 'size': os.path.getsize(path)})
+        # GApps are not part of the build manifest, but belong in the root folder
+        for name in os.listdir(plan.target_dir):
+            path = os.path.join(plan.target_dir, name)
+            if name.startswith("MindTheGapps") and name.endswith(".zip") and path not in zips:
+                zips.append(path)
+
+        hashed_bytes = 0
+        for result in hash_files(expected, workers or self.verify_workers):
+            path = result['path']
+            if result['error']:
+                status = "unreadable"
+            elif result['sha256'] == expected[path]:
+                status = "ok"
+                self.remember_checksum(path, result['sha256'])
+            else:
+                status = "mismatch"
+            hashed_bytes += result['size']
+            speed = result['size'] / max(result['seconds'], 0.001)
+            self.log_message(f"{status:<10} {os.path.basename(path)} ({format_size(result['size'])}, "
+                             f"{format_size(speed)}/s)")
+            results.append({'file': path, 'status': status, 'size': result['size']})
+        for path in zips:
+            status = "ok" if self.is_valid_zip(path) else "corrupt"
+            self.log_message(f"{status:<10} {os.path.basename(path)} (zip check: {self.zip_check_level})")
+            results.append({'file': path, 'status': status, 'size': os.path.getsize(path)})
+
+        ini_path = os.path.join(plan.target_dir, "bootloader", "ini", "android.ini")
+        try:
+            with open(ini_path, "r") as f:
+                ini_status = "ok" if f.read() == ANDROID_INI else "differs"
+        except OSError:
+            ini_status = "missing"
+        results.append({'file': ini_path, 'status': ini_status, 'size': 0})
+
+        for result in results:
+            if result['status'] in ("missing", "present", "differs"):
+                self.log_message(f"{result['status']:<10} {os.path.relpath(result['file'], plan.target_dir)}")
+        seconds = max(time.monotonic() - started_at, 0.001)
+        problems = [result for result in results if result['status'] not in ("ok", "present")]
+        self.log_message(
+            f"Verified {len(results)} files in {seconds:.1f}s, hashing {format_size(hashed_bytes)} at "
+            f"{format_size(hashed_bytes / seconds)}/s: {len(problems)} problem{'s' if len(problems) != 1 else ''}"
+        )
+        return results
+
+    def is_valid_zip(self, file_path):
+        with self.metrics.span('zip_check', os.path.basename(file_path), level=self.zip_check_level) as span:
+            span['valid'] = self.zip_validator.validate(file_path, self.zip_check_level)
+        return span['valid']
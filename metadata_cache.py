@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from file_utils import write_json_atomic
+
+
+class MetadataCache:
+    # On-disk cache for the build API and GitHub release JSON. Responses are
+    # revalidated with If-None-Match / If-Modified-Since, and a stale copy is
+    # served for up to offline_ttl seconds when the network is unavailable.
+    def __init__(self, root, fresh_for=0, offline_ttl=7 * 24 * 3600):
+        self.root = root
+        self.fresh_for = fresh_for
+        self.offline_ttl = offline_ttl
+        self.lock = threading.Lock()
+        self.stats_path = os.path.join(root, "stats.json")
+        self.stats_data = self.load_stats()
+
+    def load_stats(self):
+        try:
+            with open(self.stats_path, "r") as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {}
+        for key in ('requests', 'downloads', 'not_modified', 'fresh_hits', 'offline_hits', 'bytes_saved'):
+            stats.setdefault(key, 0)
+        return stats
+
+    def count(self, **increments):
+        with self.lock:
+            for key, value in increments.items():
+                self.stats_data[key] += value
+            write_json_atomic(self.stats_path, self.stats_data)
+
+    def entry_path(self, url):
+        return os.path.join(self.root, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def load(self, url):
+        try:
+            with open(self.entry_path(url), "r") as f:
+                entry = json.load(f)
+            return entry if entry.get('url') == url else None
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url, entry):
+        write_json_atomic(self.entry_path(url), entry)
+
+    def get_json(self, session, url, headers=None, timeout=None):
+        entry = self.load(url)
+        now = time.time()
+        if entry and now - entry['fetched_at'] < self.fresh_for:
+            self.count(fresh_hits=1, bytes_saved=entry.get('size', 0))
+            return entry['body']
+
+        request_headers = dict(headers or {})
+        if entry:
+            if entry.get('etag'):
+                request_headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                request_headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = session.get(url, headers=request_headers, timeout=timeout)
+            if response.status_code == 304 and entry:
+                entry['fetched_at'] = now
+                self.store(url, entry)
+                self.count(requests=1, not_modified=1, bytes_saved=entry.get('size', 0))
+                return entry['body']
+            response.raise_for_status()
+            body = response.json()
+        except Exception as e:
+            if entry and now - entry['fetched_at'] < self.offline_ttl:
+                logging.warning(f"Serving cached metadata for {url} after error: {e}")
+                self.count(offline_hits=1)
+                return entry['body']
+            raise
+
+        self.store(url, {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': now,
+            'size': len(response.content),
+            'body': body
+        })
+        self.count(requests=1, downloads=1)
+        return body
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.stats_data)
+        stats['saved_requests'] = stats['not_modified'] + stats['fresh_hits'] + stats['offline_hits']
+        return stats
+
+    def format_stats(self):
+        stats = self.stats()
+        return "\n".join([
+            f"Metadata cache: {self.root}",
+            f"Requests: {stats['requests']}  Full responses: {stats['downloads']}  "
+            f"Not modified: {stats['not_modified']}",
+            f"Served without a request: {stats['fresh_hits']}  Served offline: {stats['offline_hits']}  "
+            f"Saved: {stats['saved_requests']} requests, {stats['bytes_saved']} bytes",
+        ])
@@ -0,0 +1,134 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = "lineageos"
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class PipelineMetrics:
+    # Counters and per-phase timings for the download pipeline. Every span and
+    # file summary is also appended to a JSON lines file once one is opened.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, ((label, value), ...)) -> number
+        self.phases = {}  # phase -> [count, total seconds, max seconds]
+        self.sink = None
+
+    def open(self, path):
+        with self.lock:
+            if self.sink:
+                self.sink.close()
+            self.sink = open(path, "a", buffering=1, encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            if self.sink:
+                self.sink.close()
+                self.sink = None
+
+    def emit(self, kind, **fields):
+        if self.sink is None:
+            return
+        line = json.dumps(dict(type=kind, ts=round(time.time(), 3), **fields))
+        with self.lock:
+            if self.sink:
+                self.sink.write(line + "\n")
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def observe(self, phase, seconds, file=None, **fields):
+        with self.lock:
+            stats = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        self.emit("span", phase=phase, file=file, seconds=round(seconds, 6), **fields)
+
+    @contextmanager
+    def span(self, phase, file=None, **fields):
+        # Callers may add attributes (bytes, status, ...) to the yielded dict
+        started = time.monotonic()
+        try:
+            yield fields
+        except BaseException as e:
+            fields.setdefault('error', type(e).__name__)
+            raise
+        finally:
+            self.observe(phase, time.monotonic() - started, file, **fields)
+
+    def snapshot(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters[name + label_text(labels)] = value
+            phases = {phase: {'count': count, 'seconds': round(total, 6), 'max': round(longest, 6)}
+                      for phase, (count, total, longest) in self.phases.items()}
+        return {'counters': counters, 'phases': phases}
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            phases = sorted(self.phases.items())
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            if metric not in declared:
+                lines.append(f"# TYPE {metric} counter")
+                declared.add(metric)
+            lines.append(f"{metric}{label_text(labels)} {value}")
+        if phases:
+            metric = f"{PROMETHEUS_PREFIX}_phase_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for phase, (count, total, _) in phases:
+                lines.append(f"{metric}_sum{label_text([('phase', phase)])} {total:.6f}")
+                lines.append(f"{metric}_count{label_text([('phase', phase)])} {count}")
+            lines.append(f"# TYPE {metric}_max gauge")
+            for phase, (_, _, longest) in phases:
+                lines.append(f"{metric}_max{label_text([('phase', phase)])} {longest:.6f}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port, host="0.0.0.0"):
+    # Prometheus text format on http://host:port/metrics, served from a daemon thread.
+    # http.server is imported here so importing the core does not pay for it.
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = self.server.metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
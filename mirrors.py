@@ -0,0 +1,116 @@
+import json
+import time
+import threading
+from urllib.parse import urlsplit
+
+from file_utils import write_json_atomic
+
+
+def split_base(url, final_url):
+    # https://mirror.example/pub/lineageos/full/nx/x.zip redirected from
+    # https://mirrorbits.lineageos.org/full/nx/x.zip has base https://mirror.example/pub/lineageos
+    original = urlsplit(url)
+    final = urlsplit(final_url)
+    if not original.path or not final.path.endswith(original.path):
+        return None
+    prefix = final.path[:len(final.path) - len(original.path)]
+    return f"{final.scheme}://{final.netloc}{prefix}"
+
+
+class MirrorSelector:
+    def __init__(self, path, probe_bytes=256 * 1024, cooldown=600, alpha=0.3):
+        self.path = path
+        self.probe_bytes = probe_bytes
+        self.cooldown = cooldown  # Seconds a failing mirror sits out, doubled per failure
+        self.alpha = alpha  # Weight of the newest sample in the moving averages
+        self.lock = threading.Lock()
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data.setdefault('origins', {})
+        return data
+
+    def save(self):
+        write_json_atomic(self.path, self.data)
+
+    def learn(self, url, final_url):
+        if not final_url or final_url == url:
+            return None
+        base = split_base(url, final_url)
+        if base is None:
+            return None
+        with self.lock:
+            mirrors = self.data['origins'].setdefault(urlsplit(url).netloc, {})
+            if base not in mirrors:
+                mirrors[base] = {'ttfb': None, 'throughput': None, 'successes': 0,
+                                 'failures': 0, 'last_failure': 0}
+                self.save()
+        return base
+
+    def find(self, mirror_url):
+        # A copy, since other workers update the stats while this one looks at them
+        with self.lock:
+            stats = self.stats_for(mirror_url)
+            return dict(stats) if stats is not None else None
+
+    def stats_for(self, mirror_url):
+        # Callers hold self.lock; learn() may be adding mirrors from another thread
+        for mirrors in self.data['origins'].values():
+            for base, stats in mirrors.items():
+                if mirror_url.startswith(base + "/"):
+                    return stats
+        return None
+
+    def healthy(self, stats):
+        if not stats['failures']:
+            return True
+        backoff = self.cooldown * 2 ** min(stats['failures'] - 1, 5)
+        return time.time() - stats['last_failure'] > backoff
+
+    def record_success(self, mirror_url, ttfb, throughput):
+        with self.lock:
+            stats = self.stats_for(mirror_url)
+            if stats is None:
+                return
+            for key, value in (('ttfb', ttfb), ('throughput', throughput)):
+                if value is None:
+                    continue
+                previous = stats[key]
+                stats[key] = value if previous is None else previous + self.alpha * (value - previous)
+            stats['successes'] += 1
+            stats['failures'] = 0
+            self.save()
+
+    def record_failure(self, mirror_url):
+        with self.lock:
+            stats = self.stats_for(mirror_url)
+            if stats is None:
+                return
+            stats['failures'] += 1
+            stats['last_failure'] = time.time()
+            self.save()
+
+    def unmeasured(self, url):
+        return [mirror_url for mirror_url, stats in self.candidates(url) if stats['throughput'] is None]
+
+    def candidates(self, url):
+        parts = urlsplit(url)
+        suffix = parts.path + (f"?{parts.query}" if parts.query else "")
+        with self.lock:
+            mirrors = dict(self.data['origins'].get(parts.netloc, {}))
+        return [(base + suffix, stats) for base, stats in mirrors.items() if self.healthy(stats)]
+
+    def rank(self, url, exclude=()):
+        # Measured healthy mirrors, fastest first; the redirecting origin URL is always the last resort
+        ranked = sorted(
+            ((mirror_url, stats) for mirror_url, stats in self.candidates(url)
+             if stats['throughput'] is not None and mirror_url not in exclude),
+            key=lambda item: item[1]['throughput'],
+            reverse=True
+        )
+        return [mirror_url for mirror_url, _ in ranked] + [url]
@@ -0,0 +1,141 @@
+import time
+import random
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+
+class DownloadStalled(Exception):
+    pass
+
+
+class TimeBudgetExceeded(Exception):
+    pass
+
+
+def retry_after(response):
+    # Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_read_timeout(error):
+    # requests raises ReadTimeout before the body and ConnectionError(ReadTimeoutError)
+    # while streaming; raw reads raise urllib3's ReadTimeoutError. Matched by name so
+    # this module does not pull requests onto the startup path.
+    pending = [error]
+    seen = set()
+    while pending:
+        error = pending.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if type(error).__name__ in ("ReadTimeout", "ReadTimeoutError"):
+            return True
+        pending.extend(arg for arg in getattr(error, 'args', ()) if isinstance(arg, BaseException))
+        pending.extend([error.__cause__, error.__context__])
+    return False
+
+
+class LinkMeter:
+    # Throughput of every stream together over a sliding window, and the best
+    # per-stream share seen so far, so a slow link is not mistaken for a stall
+    def __init__(self, window=20.0):
+        self.window = window
+        self.started = time.monotonic()
+        self.samples = deque()
+        self.received = 0
+        self.best_share = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, amount, streams):
+        now = time.monotonic()
+        with self.lock:
+            self.samples.append((now, amount))
+            self.received += amount
+            while self.samples and now - self.samples[0][0] > self.window:
+                self.received -= self.samples.popleft()[1]
+            # Early on the rate is taken over at least a quarter window, so a first burst does not inflate it
+            elapsed = max(min(now - self.started, self.window), self.window / 4)
+            self.best_share = max(self.best_share, self.received / elapsed / max(streams, 1))
+            return self.best_share
+
+
+class StallDetector:
+    # Throughput of one stream over a sliding window. A stream slower than
+    # floor bytes/s for a whole window raises DownloadStalled, so the caller
+    # re-requests from where the file stands instead of waiting on a trickle.
+    # With a LinkMeter the floor is also held to a quarter of the best
+    # per-stream share the link has managed, so streams on a link that is
+    # simply slow keep going.
+    def __init__(self, floor, window=20.0, deadline=None, meter=None, streams=None):
+        self.floor = floor
+        self.window = window
+        self.deadline = deadline
+        self.meter = meter
+        self.streams = streams  # Callable returning the number of open streams
+        self.started = time.monotonic()
+        self.samples = deque()
+        self.received = 0  # Bytes inside the window
+
+    def record(self, amount):
+        now = time.monotonic()
+        if self.deadline and now > self.deadline:
+            raise TimeBudgetExceeded("time budget for this file is used up")
+        if not self.floor:
+            return
+        floor = self.floor
+        if self.meter:
+            floor = min(floor, self.meter.record(amount, self.streams()) / 4)
+        self.samples.append((now, amount))
+        self.received += amount
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.received -= self.samples.popleft()[1]
+        if now - self.started >= self.window and self.received < floor * self.window:
+            rate = self.received / self.window
+            raise DownloadStalled(f"stalled at {rate / 1024:.1f} KB/s over {self.window:.0f}s")
+
+
+class RetryPolicy:
+    # Decides per error class whether and when a file is tried again
+    kinds = ("stall", "throttled", "missing", "transient")
+
+    def __init__(self, base_delay=1.0, max_delay=60.0, max_stalls=5):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_stalls = max_stalls  # Stalled attempts in a row that moved the file no further
+
+    def classify(self, error):
+        if isinstance(error, DownloadStalled) or is_read_timeout(error):
+            return "stall"
+        if isinstance(error, TimeBudgetExceeded):
+            return "budget"
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status in (429, 503):
+            return "throttled"
+        if status in (404, 410):
+            return "missing"
+        return "transient"
+
+    def backoff(self, failures):
+        # Exponential, with jitter so parallel workers do not retry in lockstep
+        delay = min(self.max_delay, self.base_delay * 2 ** max(failures - 1, 0))
+        return random.uniform(delay / 2, delay)
+
+    def delay_for(self, kind, error, failures):
+        if kind == "stall":
+            return 0.0  # A fresh request usually lands on a healthier connection or mirror
+        if kind == "throttled":
+            wait = retry_after(getattr(error, 'response', None))
+            if wait is not None:
+                return wait
+        return self.backoff(failures)
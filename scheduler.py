@@ -0,0 +1,143 @@
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+
+def host_of(url):
+    return urlsplit(url).hostname or ""
+
+
+class DownloadCanceled(Exception):
+    pass
+
+
+class TokenBucket:
+    # Shared by every transfer thread; rate is bytes per second, 0 means unlimited
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 256 * 1024)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount, is_canceled=None):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # Chunks larger than the bucket are let through once it is full
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            if is_canceled and is_canceled():
+                raise DownloadCanceled()
+            time.sleep(min(wait, 0.25))
+
+
+class ConnectionLimiter:
+    # Budget for open HTTP connections, counted per request so range segments share it
+    def __init__(self, total=8, per_host=4):
+        self.total = threading.BoundedSemaphore(total)
+        self.per_host_limit = per_host
+        self.per_host = {}
+        self.lock = threading.Lock()
+
+    def host_semaphore(self, url):
+        host = host_of(url)
+        with self.lock:
+            if host not in self.per_host:
+                self.per_host[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self.per_host[host]
+
+    @contextmanager
+    def slot(self, url, is_canceled=None):
+        host_slot = self.host_semaphore(url)
+        # Always host first, then global, so two waiters can never hold each other's slot
+        self.acquire(host_slot, is_canceled)
+        try:
+            self.acquire(self.total, is_canceled)
+            try:
+                yield
+            finally:
+                self.total.release()
+        finally:
+            host_slot.release()
+
+    def acquire(self, semaphore, is_canceled):
+        while not semaphore.acquire(timeout=0.25):
+            if is_canceled and is_canceled():
+                raise DownloadCanceled()
+
+
+def abort_response(response):
+    # Closing alone does not wake a thread blocked in recv(); shutting the socket down does
+    try:
+        connection = getattr(response.raw, "_connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
+    try:
+        response.close()
+    except Exception as e:
+        logging.debug(f"Error closing response: {e}")
+
+
+class DownloadScheduler:
+    def __init__(self, core, jobs=4, per_host=4):
+        self.core = core
+        self.jobs = jobs
+        self.per_host = per_host
+        self.loop = None
+        self.tasks = []
+
+    def run(self, items):
+        # asyncio is imported here so merely importing the core (e.g. the GUI at startup) skips it
+        import asyncio
+        asyncio.run(self.run_async(items))
+
+    async def run_async(self, items):
+        import asyncio
+        # items are (url, plan) pairs, possibly from several build plans
+        self.loop = asyncio.get_running_loop()
+        file_slots = asyncio.Semaphore(self.jobs)
+        host_slots = {}
+        # Largest first so the big zip starts immediately and small files fill in around it
+        order = sorted(items, key=lambda item: item[1].sizes.get(item[0]) or 0, reverse=True)
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for url, plan in order:
+                host = host_of(url)
+                if host not in host_slots:
+                    host_slots[host] = asyncio.Semaphore(self.per_host)
+                self.tasks.append(asyncio.ensure_future(
+                    self.run_file(executor, file_slots, host_slots[host], url, plan)))
+            self.core.add_cancel_hook(self.cancel_from_thread)
+            try:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            finally:
+                self.core.remove_cancel_hook(self.cancel_from_thread)
+
+    async def run_file(self, executor, file_slots, host_slot, url, plan):
+        async with file_slots:
+            async with host_slot:
+                if self.core.cancel_download:
+                    return
+                await self.loop.run_in_executor(executor, self.core.download_file, url, plan)
+
+    def cancel_from_thread(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.cancel_pending)
+
+    def cancel_pending(self):
+        # Queued files are dropped; running ones unwind once their sockets are shut down
+        for task in self.tasks:
+            task.cancel()
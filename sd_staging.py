@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+
+from chunk_reader import write_all
+
+
+def preallocate(f, size):
+    # Reserves the whole file up front so FAT32/exFAT can hand out one contiguous run
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # e.g. not supported by the filesystem
+    if os.fstat(f.fileno()).st_size < size:
+        f.truncate(size)
+
+
+def mount_point(path):
+    path = os.path.abspath(path)
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        return drive + os.sep
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def sync_file(path):
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def sync_directory(path):
+    # Makes renames durable on POSIX; Windows cannot open directories for this
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def copy_staged(source_path, dest_path, block_size, on_write):
+    # A local copy onto the card with the same preallocation and aligned writes as a download
+    size = os.path.getsize(source_path)
+    with open(source_path, "rb") as source, open(dest_path, "wb", buffering=0) as f:
+        preallocate(f, size)
+        writer = BlockWriter(f, 0, block_size, on_write)
+        for data in iter(lambda: source.read(block_size), b""):
+            writer.write(data)
+        writer.flush()
+        f.truncate(size)
+
+
+class BlockWriter:
+    # Collects stream chunks and writes them in block_size pieces that start on
+    # block boundaries, which is what SD card controllers erase and program
+    def __init__(self, f, offset, block_size, on_write):
+        self.f = f
+        self.offset = offset
+        self.block_size = block_size
+        self.buffer = bytearray(block_size)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        self.limit = block_size - offset % block_size  # The first block ends at the next boundary
+        self.on_write = on_write  # on_write(offset, data, seconds) after each block reaches the file
+
+    def write(self, data):
+        while data:
+            take = min(len(data), self.limit - self.filled)
+            self.view[self.filled:self.filled + take] = data[:take]
+            self.filled += take
+            data = data[take:]
+            if self.filled == self.limit:
+                self.flush()
+
+    def flush(self):
+        if not self.filled:
+            return
+        block = self.view[:self.filled]
+        started = time.monotonic()
+        self.f.seek(self.offset)  # Several writers may share one file, e.g. for fan-out targets
+        write_all(self.f, block)
+        self.on_write(self.offset, block, time.monotonic() - started)
+        self.offset += self.filled
+        self.filled = 0
+        self.limit = self.block_size
+
+
+class WriteStats:
+    # Bytes and time spent writing and syncing, per target device
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.mounts = {}
+
+    def reset(self):
+        with self.lock:
+            self.devices = {}
+
+    def device(self, path):
+        folder = os.path.dirname(os.path.abspath(path))
+        if folder not in self.mounts:
+            self.mounts[folder] = mount_point(folder)
+        mount = self.mounts[folder]
+        return self.devices.setdefault(mount, {'bytes': 0, 'write_seconds': 0.0, 'sync_seconds': 0.0})
+
+    def record_write(self, path, amount, seconds):
+        with self.lock:
+            stats = self.device(path)
+            stats['bytes'] += amount
+            stats['write_seconds'] += seconds
+
+    def record_sync(self, path, seconds):
+        with self.lock:
+            self.device(path)['sync_seconds'] += seconds
+
+    def report(self, format_size):
+        lines = []
+        with self.lock:
+            for mount, stats in sorted(self.devices.items()):
+                busy = max(stats['write_seconds'] + stats['sync_seconds'], 0.001)
+                lines.append(
+                    f"{mount}: {format_size(stats['bytes'])} written at {format_size(stats['bytes'] / busy)}/s "
+                    f"(writes {stats['write_seconds']:.1f}s, fsync {stats['sync_seconds']:.1f}s)"
+                )
+        return lines
@@ -0,0 +1,40 @@
+import os
+import mmap
+import time
+import hashlib
+
+
+def hash_file(path, block_size=16 * 1024 * 1024):
+    # Runs in a worker process; the file is mapped, so blocks are hashed
+    # straight from the page cache without a read copy
+    started = time.monotonic()
+    sha256_hash = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        for offset in range(0, size, block_size):
+                            sha256_hash.update(view[offset:offset + block_size])
+    except OSError as e:
+        return {'path': path, 'sha256': None, 'size': 0, 'seconds': time.monotonic() - started, 'error': str(e)}
+    return {'path': path, 'sha256': sha256_hash.hexdigest(), 'size': size,
+            'seconds': time.monotonic() - started, 'error': None}
+
+
+def hash_files(paths, workers=None):
+    # Yields hash_file results as they finish, largest files first so the tail is short
+    paths = sorted(paths, key=lambda path: os.path.getsize(path) if os.path.exists(path) else 0, reverse=True)
+    if not paths:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    if workers < 2:
+        for path in paths:
+            yield hash_file(path)
+        return
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(hash_file, path) for path in paths]
+        for future in as_completed(futures):
+            yield future.result()
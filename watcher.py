@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+
+from file_utils import write_json_atomic
+
+
+def lower_priority():
+    # Prefetching must not compete with whatever the machine is used for meanwhile
+    try:
+        if hasattr(os, "nice"):
+            os.nice(10)
+        elif sys.platform == "win32":
+            import ctypes
+            below_normal = 0x4000  # BELOW_NORMAL_PRIORITY_CLASS
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), below_normal)
+    except (OSError, AttributeError) as e:
+        logging.warning(f"Could not lower process priority: {e}")
+
+
+class BuildWatcher:
+    # Polls the build API and MindTheGapps on a jittered schedule and
+    # downloads every new build into download_dir, so the tree is ready
+    # before anyone asks for it. What is already prepared is kept in
+    # watcher.json; metadata requests go through the metadata cache, so an
+    # unchanged API costs a 304.
+    def __init__(self, core, devices, download_dir, gapps=True, interval=3600, jitter=0.2,
+                 retry_interval=600):
+        self.core = core
+        self.devices = devices
+        self.download_dir = download_dir
+        self.gapps = gapps
+        self.interval = interval
+        self.jitter = jitter
+        self.retry_interval = retry_interval  # Sooner poll after a failed check or download
+        self.state_path = os.path.join(core.state_dir, "watcher.json")
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.state = self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        with self.lock:
+            write_json_atomic(self.state_path, self.state, indent=2)
+
+    def build_key(self, plan):
+        return f"{plan.label()}/{plan.gapps_filename or '-'}"
+
+    def is_ready(self, plan):
+        entry = self.state.get(plan.device, {})
+        return entry.get('key') == self.build_key(plan) and os.path.isdir(entry.get('target_dir', ''))
+
+    def poll_once(self):
+        # True when every device's newest build is ready in download_dir
+        try:
+            plans = self.core.resolve_batch(self.devices, count=1, gapps=self.gapps)
+        except Exception as e:
+            self.core.log_message(f"Watcher could not check for new builds: {str(e)}")
+            return False
+        pending = [plan for plan in plans if not self.is_ready(plan)]
+        now = time.time()
+        for plan in plans:
+            self.state.setdefault(plan.device, {})['checked'] = now
+        if not pending:
+            self.core.log_message("No new builds; the latest trees are already prepared")
+            self.save_state()
+            return True
+        if self.stopped.is_set():
+            return False
+        for plan in pending:
+            self.core.log_message(f"New build for {plan.device}: {self.build_key(plan)}; prefetching")
+            self.core.create_folders_and_ini(plan, self.download_dir)
+        ok = self.core.download_batch(pending)
+        if ok:
+            for plan in pending:
+                self.state[plan.device].update(key=self.build_key(plan), target_dir=plan.target_dir, ready=time.time())
+                self.core.log_message(f"Ready to copy: {plan.target_dir}")
+        self.save_state()
+        return ok
+
+    def next_delay(self, ok):
+        delay = self.interval if ok else min(self.retry_interval, self.interval)
+        # Jitter keeps several watchers from hitting the API in lockstep
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self):
+        while not self.stopped.is_set():
+            ok = self.poll_once()
+            if self.stopped.is_set():
+                return
+            delay = self.next_delay(ok)
+            self.core.log_message(f"Next check in {delay / 60:.0f} min")
+            self.stopped.wait(delay)
+
+    def stop(self):
+        self.stopped.set()
+        self.core.cancel()
@@ -0,0 +1,148 @@
+import struct
+
+EOCD_SIGNATURE = b"PK\x05\x06"
+ZIP64_EOCD_SIGNATURE = b"PK\x06\x06"
+ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+CENTRAL_SIGNATURE = b"PK\x01\x02"
+LOCAL_SIGNATURE = b"PK\x03\x04"
+
+EOCD_SIZE = 22
+ZIP64_LOCATOR_SIZE = 20
+ZIP64_EOCD_SIZE = 56
+LOCAL_HEADER_SIZE = 30
+CENTRAL_HEADER_SIZE = 46
+MAX_COMMENT = 0xFFFF
+FLAG_DATA_DESCRIPTOR = 0x08
+
+
+class ZipFormatError(ValueError):
+    pass
+
+
+class ZipEntry:
+    def __init__(self, name, flags, method, crc, compressed_size, file_size, header_offset):
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.crc = crc
+        self.compressed_size = compressed_size
+        self.file_size = file_size
+        self.header_offset = header_offset
+
+    def signature(self):
+        # Entries with the same signature carry identical compressed bytes
+        return (self.name, self.method, self.crc, self.compressed_size, self.file_size)
+
+
+class ZipDirectory:
+    def __init__(self, entries, cd_offset, cd_size, archive_size, tail_offset, tail):
+        self.entries = entries
+        self.cd_offset = cd_offset
+        self.cd_size = cd_size
+        self.archive_size = archive_size
+        self.tail_offset = tail_offset  # Where the raw bytes in tail start
+        self.tail = tail  # Central directory through end of file
+
+    def by_name(self):
+        return {entry.name: entry for entry in self.entries}
+
+
+def read_directory(read_at, archive_size):
+    # read_at(offset, length) -> bytes; works the same for local files and HTTP ranges
+    tail_length = min(archive_size, EOCD_SIZE + MAX_COMMENT + ZIP64_LOCATOR_SIZE + ZIP64_EOCD_SIZE)
+    tail_offset = archive_size - tail_length
+    tail = read_at(tail_offset, tail_length)
+
+    position = tail.rfind(EOCD_SIGNATURE)
+    while position >= 0:
+        comment_length = struct.unpack_from("<H", tail, position + 20)[0]
+        if position + EOCD_SIZE + comment_length == len(tail):
+            break
+        position = tail.rfind(EOCD_SIGNATURE, 0, position)
+    if position < 0:
+        raise ZipFormatError("End of central directory not found")
+
+    (_, disk, cd_disk, _, entry_count, cd_size, cd_offset,
+     _) = struct.unpack_from("<4sHHHHIIH", tail, position)
+    if disk != 0 or cd_disk != 0:
+        raise ZipFormatError("Multi-disk archives are not supported")
+
+    locator = position - ZIP64_LOCATOR_SIZE
+    if locator >= 0 and tail[locator:locator + 4] == ZIP64_LOCATOR_SIGNATURE:
+        zip64_offset = struct.unpack_from("<Q", tail, locator + 8)[0]
+        if zip64_offset >= tail_offset:
+            record = tail[zip64_offset - tail_offset:zip64_offset - tail_offset + ZIP64_EOCD_SIZE]
+        else:
+            record = read_at(zip64_offset, ZIP64_EOCD_SIZE)
+        if record[:4] != ZIP64_EOCD_SIGNATURE:
+            raise ZipFormatError("Zip64 end of central directory not found")
+        entry_count, cd_size, cd_offset = struct.unpack_from("<QQQ", record, 32)
+
+    if cd_offset + cd_size > archive_size:
+        raise ZipFormatError("Central directory extends past end of file")
+    if cd_offset < tail_offset:
+        extra = read_at(cd_offset, tail_offset - cd_offset)
+        tail = extra + tail
+        tail_offset = cd_offset
+
+    central = tail[cd_offset - tail_offset:cd_offset - tail_offset + cd_size]
+    entries = parse_central_directory(central, entry_count)
+    return ZipDirectory(entries, cd_offset, cd_size, archive_size,
+                        cd_offset, tail[cd_offset - tail_offset:])
+
+
+def parse_central_directory(data, entry_count):
+    entries = []
+    position = 0
+    for _ in range(entry_count):
+        if data[position:position + 4] != CENTRAL_SIGNATURE:
+            raise ZipFormatError(f"Bad central directory entry at {position}")
+        (flags, method, crc, compressed_size, file_size, name_length, extra_length,
+         comment_length, header_offset) = struct.unpack_from("<8xHH4xIIIHHH8xI", data, position)
+        name_start = position + CENTRAL_HEADER_SIZE
+        raw_name = data[name_start:name_start + name_length]
+        extra = data[name_start + name_length:name_start + name_length + extra_length]
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        file_size, compressed_size, header_offset = apply_zip64_extra(
+            extra, file_size, compressed_size, header_offset)
+        entries.append(ZipEntry(name, flags, method, crc, compressed_size, file_size, header_offset))
+        position = name_start + name_length + extra_length + comment_length
+    return entries
+
+
+def apply_zip64_extra(extra, file_size, compressed_size, header_offset):
+    position = 0
+    while position + 4 <= len(extra):
+        tag, size = struct.unpack_from("<HH", extra, position)
+        if tag == 0x0001:
+            values = iter(struct.unpack_from(f"<{size // 8}Q", extra, position + 4))
+            # Only the fields that overflowed in the fixed header are present, in this order
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        position += 4 + size
+    return file_size, compressed_size, header_offset
+
+
+def local_header_length(header):
+    if header[:4] != LOCAL_SIGNATURE:
+        raise ZipFormatError("Bad local file header")
+    name_length, extra_length = struct.unpack_from("<HH", header, 26)
+    return LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def entry_regions(directory):
+    # (entry, start, end) spans covering each member up to the next member or the
+    # central directory, including data descriptors and any padding in between
+    ordered = sorted(directory.entries, key=lambda entry: entry.header_offset)
+    regions = []
+    for index, entry in enumerate(ordered):
+        end = ordered[index + 1].header_offset if index + 1 < len(ordered) else directory.cd_offset
+        if end < entry.header_offset:
+            raise ZipFormatError(f"Overlapping members at {entry.name}")
+        regions.append((entry, entry.header_offset, end))
+    return regions
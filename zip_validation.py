@@ -0,0 +1,141 @@
+import os
+import json
+import zlib
+import struct
+import zipfile
+import threading
+
+from file_utils import write_json_atomic
+from zip_structure import (read_directory, entry_regions, local_header_length,
+                           LOCAL_SIGNATURE, LOCAL_HEADER_SIZE, FLAG_DATA_DESCRIPTOR, ZipFormatError)
+
+LEVELS = {"structure": 1, "crc": 2}
+
+
+def check_structure(path):
+    # Central directory and local headers must agree and every member must fit
+    # before the next one; no member data is decompressed
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        def read_at(offset, length):
+            f.seek(offset)
+            return f.read(length)
+
+        directory = read_directory(read_at, size)
+        for entry, start, end in entry_regions(directory):
+            header = read_at(start, LOCAL_HEADER_SIZE)
+            if header[:4] != LOCAL_SIGNATURE:
+                raise ZipFormatError(f"Missing local header for {entry.name}")
+            header_length = local_header_length(header)
+            name_length = struct.unpack_from("<H", header, 26)[0]
+            name = read_at(start + LOCAL_HEADER_SIZE, name_length)
+            if name.decode("utf-8" if entry.flags & 0x800 else "cp437") != entry.name:
+                raise ZipFormatError(f"Local header name differs for {entry.name}")
+            method, crc, compressed_size = struct.unpack_from("<8xH4xII", header, 0)
+            if method != entry.method:
+                raise ZipFormatError(f"Compression method differs for {entry.name}")
+            if not entry.flags & FLAG_DATA_DESCRIPTOR and crc != entry.crc:
+                raise ZipFormatError(f"CRC differs between headers for {entry.name}")
+            if (not entry.flags & FLAG_DATA_DESCRIPTOR and compressed_size != 0xFFFFFFFF
+                    and compressed_size != entry.compressed_size):
+                raise ZipFormatError(f"Compressed size differs between headers for {entry.name}")
+            if start + header_length + entry.compressed_size > end:
+                raise ZipFormatError(f"{entry.name} runs past the next member")
+    return directory
+
+
+def check_members(path, names):
+    # Runs in a worker process; zipfile checks the CRC when a member is read to the end
+    with zipfile.ZipFile(path, "r") as archive:
+        for name in names:
+            try:
+                with archive.open(name) as member:
+                    while member.read(1024 * 1024):
+                        pass
+            except (zipfile.BadZipFile, zlib.error, EOFError):
+                return name
+    return None
+
+
+def balance(entries, workers):
+    # Greedy largest-first packing so each worker gets a similar number of bytes
+    bins = [[0, []] for _ in range(workers)]
+    for entry in sorted(entries, key=lambda entry: entry.compressed_size, reverse=True):
+        target = min(bins, key=lambda item: item[0])
+        target[0] += entry.compressed_size
+        target[1].append(entry.name)
+    return [names for _, names in bins if names]
+
+
+class ZipValidator:
+    def __init__(self, cache_path, workers=None, parallel_threshold=64 * 1024 * 1024):
+        self.cache_path = cache_path
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold  # Smaller zips are checked in-process
+        self.lock = threading.Lock()
+        self.results = None
+
+    def load(self):
+        if self.results is None:
+            try:
+                with open(self.cache_path, "r") as f:
+                    self.results = json.load(f)
+            except (OSError, ValueError):
+                self.results = {}
+        return self.results
+
+    def save(self):
+        write_json_atomic(self.cache_path, self.results)
+
+    def cached_level(self, path, stat):
+        with self.lock:
+            record = self.load().get(os.path.abspath(path))
+        if record and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['level']
+        return 0
+
+    def remember(self, path, level):
+        stat = os.stat(path)
+        with self.lock:
+            self.load()[os.path.abspath(path)] = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'level': LEVELS[level]
+            }
+            self.save()
+
+    def rename(self, old_path, new_path):
+        # A rename keeps size and mtime, so the earlier result still applies
+        with self.lock:
+            record = self.load().pop(os.path.abspath(old_path), None)
+            if record:
+                self.results[os.path.abspath(new_path)] = record
+                self.save()
+
+    def validate(self, path, level="crc"):
+        try:
+            stat = os.stat(path)
+            if self.cached_level(path, stat) >= LEVELS[level]:
+                return True
+            directory = check_structure(path)
+            if level == "crc":
+                bad_member = self.check_crc(path, directory.entries, stat.st_size)
+                if bad_member:
+                    raise zipfile.BadZipFile(f"CRC mismatch in {bad_member}")
+        except (OSError, ValueError, zipfile.BadZipFile, struct.error, zlib.error):
+            return False
+        self.remember(path, level)
+        return True
+
+    def check_crc(self, path, entries, size):
+        entries = [entry for entry in entries if not entry.name.endswith("/")]
+        if size < self.parallel_threshold or self.workers < 2 or len(entries) < 2:
+            return check_members(path, [entry.name for entry in entries])
+        # Imported on demand; multiprocessing is a noticeable part of the core's import time
+        from concurrent.futures import ProcessPoolExecutor
+        groups = balance(entries, self.workers)
+        with ProcessPoolExecutor(max_workers=len(groups)) as executor:
+            for bad_member in executor.map(check_members, [path] * len(groups), groups):
+                if bad_member:
+                    return bad_member
+        return None